@@ -1,10 +1,21 @@
 from dotenv import get_key
+import os
 import asyncio
 import threading
 import schedule
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future
+import src.netreq as netreq
+import src.metrics as metrics
 from src.destiny import (
+    DATA_FOLDER,
     setup_destiny_data,
+    rollback_destiny_data,
+    expire_destiny_caches,
+    get_cached_search_page,
+    search_names,
+    save_name_index
 )
 from src.embeds import (
     OwnedView,
@@ -12,43 +23,190 @@ from src.embeds import (
     get_character_data_embeds,
     get_search_embed,
     get_loading_embed,
-    get_gm_data_embeds,
-    get_eververse_data_embeds,
-    get_featured_data_embeds,
+    render_static_responses,
+    get_rendered_response,
     get_account_data_embeds_weapons,
     get_top_weapons_embeds,
     get_account_data_embeds_activity,
-    get_last_activity_embeds
+    get_last_activity_embeds,
+    get_stats_embed,
+    get_timeout_embed
 )
 from src.io import timestamp_print
 import discord
 
+def refresh_destiny_data():
+    """
+    Refreshes destiny data and renders static command responses for it
+    """
+    with data_lock:
+        if setup_destiny_data():
+            render_static_responses()
+
+def rollback_destiny_data_now() -> str:
+    """
+    Goes back to the previous destiny data and renders static command responses for it,
+    returns message for the bot owner
+    """
+    if not data_lock.acquire(blocking=False):
+        return "Destiny data is being refreshed, try again later!"
+    try:
+        if not rollback_destiny_data():
+            return "There is no previous destiny data to go back to!"
+        render_static_responses()
+        return "Rolled back to the previous destiny data!"
+    finally:
+        data_lock.release()
+
+def run_job(job: callable) -> None:
+    """
+    Runs a scheduled job, an error is printed so it does not stop the scheduler and other jobs
+    """
+    try:
+        job()
+    except Exception:
+        timestamp_print(f"Scheduled job {job.__name__} failed")
+        traceback.print_exc()
+
 def run_scheduler():
     while True:
         schedule.run_pending()
         time.sleep(1)
 
+def write_metrics():
+    """
+    Writes current metrics to the Prometheus metrics file
+    """
+    metrics.write_prometheus(METRICS_FILE)
+
+def get_executor_stats() -> dict:
+    """
+    Gets queued and running work of the to_thread worker pool
+    """
+    if executor is None:
+        return {}
+    return executor.stats()
+
+class TrackedExecutor(ThreadPoolExecutor):
+    """
+    Thread pool that counts work waiting for a worker and work being run
+    """
+    def __init__(self, max_workers: int):
+        super().__init__(max_workers=max_workers)
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+
+    def submit(self, fn: callable, /, *args, **kwargs) -> Future:
+        def run():
+            with self.lock:
+                self.queued -= 1
+                self.active += 1
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+        with self.lock:
+            self.queued += 1
+        future = super().submit(run)
+        future.add_done_callback(self.on_done)
+        return future
+
+    def on_done(self, future: Future) -> None:
+        """
+        Stops counting work that was cancelled before a worker took it
+        """
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+
+    def stats(self) -> dict:
+        """
+        Gets amount of queued and running work and the worker limit
+        """
+        with self.lock:
+            return {
+                "queueDepth": self.queued,
+                "active": self.active,
+                "maxWorkers": self.max_workers
+            }
+
 API_KEY = get_key(".env", "DISCORD_API_KEY")
+METRICS_FILE = os.path.join(DATA_FOLDER, "metrics.prom")
+
+#time budget in seconds for the bungie requests of each command
+command_budgets = {
+    "lookup": 20,
+    "search": 15,
+    "topweapons": 40,
+    "lastactivity": 40
+}
+
+executor = None
+data_lock = threading.Lock() #refreshes and rollbacks of destiny data replace the same generations
+metrics.register_gauge("executor", get_executor_stats)
+
+class RobinClient(discord.Client):
+    async def close(self) -> None:
+        """
+        Disconnects from discord, then closes the bungie sessions
+        """
+        await super().close()
+        await netreq.close_async_session()
+        netreq.close_sessions()
 
 #start discord bot
 intents = discord.Intents.default()
-client = discord.Client(intents=intents)
+client = RobinClient(intents=intents)
 tree = discord.app_commands.CommandTree(client)
 
+@client.event
+async def setup_hook():
+    global executor
+    #size to_thread workers after the netreq session pool so no worker waits for a session
+    executor = TrackedExecutor(netreq.POOL_SIZE)
+    asyncio.get_running_loop().set_default_executor(executor)
+
+@client.event
+async def on_app_command_completion(context: discord.Interaction, command: discord.app_commands.Command):
+    #time from the user sending the command until it was answered
+    latency = (discord.utils.utcnow() - context.created_at).total_seconds()
+    metrics.observe("command_seconds", latency, {"command": command.name})
+
+@tree.error
+async def on_app_command_error(context: discord.Interaction, error: discord.app_commands.AppCommandError):
+    if isinstance(error, discord.app_commands.CommandInvokeError) and isinstance(error.original, netreq.DeadlineExceeded):
+        await send_timeout(context)
+    else:
+        await discord.app_commands.CommandTree.on_error(tree, context, error)
+
 @client.event
 async def on_ready():
     await tree.sync()
     timestamp_print("Robin D. Estiny: Running!")
 
 #helper functions ---------------------------------------------------------
+async def send_timeout(context: discord.Interaction):
+    """
+    Tells user that the command ran out of time waiting for bungie
+    """
+    if context.response.is_done():
+        await context.edit_original_response(embed=get_timeout_embed(), view=None)
+    else:
+        await context.response.send_message(embed=get_timeout_embed(), ephemeral=True)
+
 async def handle_eververse(first: bool, context: discord.Interaction, arg: str = None):
     """
-    Responds with embeds and view from eververse creator and sets callbacks for buttons
+    Responds with pre-rendered embeds and view of an eververse category with callbacks for buttons
     """
-    new_view = OwnedView(context.user.id)
-    embeds, view = await asyncio.to_thread(get_eververse_data_embeds, new_view, arg)
-    for button in view.children:
-        button.callback = action_callback
+    response = get_rendered_response("eververse", arg) or get_rendered_response("eververse") #category gone after refresh
+    if response is None:
+        await context.response.send_message("Eververse data is not available right now!", ephemeral=True)
+        return
+    embeds = response.get_embeds()
+    view = response.get_view(context.user.id, action_callback)
     if first:
         await context.response.send_message(embeds=embeds, view=view)
     else:
@@ -58,7 +216,7 @@ async def handle_account_character_lookup(first: bool, context: discord.Interact
     """
     Handles response for account and characters lookup
     """
-    loading_embed = await asyncio.to_thread(get_loading_embed, "lookup", name, int(tag))
+    loading_embed = get_loading_embed("lookup", name, int(tag))
     #loading to make command not time out
     if first:
         await context.response.send_message(embed=loading_embed)
@@ -71,7 +229,7 @@ async def handle_account_character_lookup(first: bool, context: discord.Interact
         await context.response.edit_message(embed=loading_embed, view=None)
     #actual response
     new_view = OwnedView(context.user.id)
-    embeds_initial, view, type, id = await asyncio.to_thread(get_account_data_embeds_lookup, new_view, name, tag, type)
+    embeds_initial, view, type, id = await get_account_data_embeds_lookup(new_view, name, tag, type)
     if not first and embeds_initial is None:
         await context.edit_original_response(embeds=original_embeds, view=original_view)
         return
@@ -83,14 +241,22 @@ async def handle_account_character_lookup(first: bool, context: discord.Interact
         for action in view.children:
             action.callback = action_callback
         await context.edit_original_response(embeds=embeds_initial, view=None)
-        embeds_full = await asyncio.to_thread(get_character_data_embeds, embeds_initial, type, id)
+        embeds_full = await get_character_data_embeds(embeds_initial, type, id)
         await context.edit_original_response(embeds=embeds_full, view=view)
 
 async def handle_search(first: bool, context: discord.Interaction, name: str, page: int = 0):
     """
     Handles the page scrolling etc of the user search
     """
-    loading_embed = await asyncio.to_thread(get_loading_embed, "search", name)
+    #cached pages are shown right away without loading, read once so it cannot expire in between
+    page_data = None if first else get_cached_search_page(name, page)
+    if page_data is not None:
+        embed, view = await get_search_embed(OwnedView(context.user.id), name, page, page_data)
+        for action in view.children:
+            action.callback = action_callback
+        await context.response.edit_message(embed=embed, view=view)
+        return
+    loading_embed = get_loading_embed("search", name)
     #loading to make command not time out
     if first:
         await context.response.send_message(embed=loading_embed)
@@ -103,7 +269,7 @@ async def handle_search(first: bool, context: discord.Interaction, name: str, pa
         await context.response.edit_message(embed=loading_embed, view=None)
     #actual response
     new_view = OwnedView(context.user.id)
-    embed, view = await asyncio.to_thread(get_search_embed, new_view, name, page)
+    embed, view = await get_search_embed(new_view, name, page)
     if not first and embed is None:
         await context.edit_original_response(embed=original_embed, view=original_view)
         return
@@ -116,10 +282,33 @@ async def handle_search(first: bool, context: discord.Interaction, name: str, pa
             action.callback = action_callback
         await context.edit_original_response(embed=embed, view=view)
 
+def split_bungie_name(name: str, tag: int) -> tuple[str, int]:
+    """
+    Splits a name#tag picked from autocomplete, a given tag is used over the one in the name
+    """
+    head, sep, tail = name.rpartition("#")
+    if sep and tail.isdigit():
+        name = head
+        tag = int(tail) if tag is None else tag
+    return name, tag
+
+async def name_autocomplete(context: discord.Interaction, current: str) -> list[discord.app_commands.Choice[str]]:
+    """
+    Suggests bungie names the bot has already seen, no bungie requests are made
+    """
+    return [discord.app_commands.Choice(name=name, value=name) for name in search_names(current)]
+
 #--------------------------------------------------------------------------
 async def action_callback(context: discord.Interaction):
     #context formatted as [type]%[data];[data];... etc
     contents = context.data["custom_id"].split("%", 1)
+    try:
+        with metrics.timer("button_seconds", {"action": contents[0]}), netreq.deadline(command_budgets.get(contents[0], 20)):
+            await handle_action(context, contents)
+    except netreq.DeadlineExceeded:
+        await send_timeout(context)
+
+async def handle_action(context: discord.Interaction, contents: list[str]):
     if contents[0] == "lookup": #user lookup
         if contents[1]: #from lookup response
             splitted = contents[1].split(";")
@@ -153,8 +342,11 @@ async def eververse(context: discord.Interaction):
     description="Get information about the current active grandmaster vanguard alert"
 )
 async def gm(context: discord.Interaction):
-    embeds = await asyncio.to_thread(get_gm_data_embeds)
-    await context.response.send_message(embeds=embeds)
+    response = get_rendered_response("gm")
+    if response is None:
+        await context.response.send_message("Grandmaster data is not available right now!", ephemeral=True)
+        return
+    await context.response.send_message(embeds=response.get_embeds())
 
 #--------------------------------------------------------------------------
 @tree.command(
@@ -162,8 +354,11 @@ async def gm(context: discord.Interaction):
     description="Get all weekly featured raids and dungeons"
 )
 async def featured(context: discord.Interaction):
-    embeds = await asyncio.to_thread(get_featured_data_embeds)
-    await context.response.send_message(embeds=embeds)
+    response = get_rendered_response("featured")
+    if response is None:
+        await context.response.send_message("Featured raid and dungeon data is not available right now!", ephemeral=True)
+        return
+    await context.response.send_message(embeds=response.get_embeds())
 
 #--------------------------------------------------------------------------
 @tree.command(
@@ -171,14 +366,18 @@ async def featured(context: discord.Interaction):
     description="Search for and get information about a Destiny account"
 )
 @discord.app_commands.describe(
-    name="Destiny username",
+    name="Destiny username, or name#tag",
     tag="The four digits after the '#'"
 )
+@discord.app_commands.autocomplete(name=name_autocomplete)
 async def lookup(context: discord.Interaction, name: str, tag: int = None):
+    name, tag = split_bungie_name(name, tag)
     if tag is None:
-        await handle_search(True, context, name.lower())
+        with netreq.deadline(command_budgets["search"]):
+            await handle_search(True, context, name.lower())
     else:
-        await handle_account_character_lookup(True, context, name.lower(), tag)
+        with netreq.deadline(command_budgets["lookup"]):
+            await handle_account_character_lookup(True, context, name.lower(), tag)
 
 #--------------------------------------------------------------------------
 @tree.command(
@@ -186,20 +385,26 @@ async def lookup(context: discord.Interaction, name: str, tag: int = None):
     description="Get the top exotic weapons for a destiny account"
 )
 @discord.app_commands.describe(
-    name="Destiny username",
+    name="Destiny username, or name#tag",
     tag="The four digits after the '#'"
 )
-async def topweapons(context: discord.Interaction, name: str, tag: int):
-    loading_embed = await asyncio.to_thread(get_loading_embed, "topweapons", name.lower(), tag)
+@discord.app_commands.autocomplete(name=name_autocomplete)
+async def topweapons(context: discord.Interaction, name: str, tag: int = None):
+    name, tag = split_bungie_name(name, tag)
+    if tag is None:
+        await context.response.send_message("Give the tag as name#tag or in the tag option!", ephemeral=True)
+        return
+    loading_embed = get_loading_embed("topweapons", name.lower(), tag)
     await context.response.send_message(embed=loading_embed)
-    embeds_initial, account_data = await asyncio.to_thread(get_account_data_embeds_weapons, name.lower(), str(tag))
-    if embeds_initial is None:
-        await context.delete_original_response()
-        await context.followup.send("User was not found!", ephemeral=True)
-    else:
-        await context.edit_original_response(embeds=embeds_initial)
-        embeds_full = await asyncio.to_thread(get_top_weapons_embeds, embeds_initial, account_data)
-        await context.edit_original_response(embeds=embeds_full)
+    with netreq.deadline(command_budgets["topweapons"]):
+        embeds_initial, account_data = await get_account_data_embeds_weapons(name.lower(), str(tag))
+        if embeds_initial is None:
+            await context.delete_original_response()
+            await context.followup.send("User was not found!", ephemeral=True)
+        else:
+            await context.edit_original_response(embeds=embeds_initial)
+            embeds_full = await get_top_weapons_embeds(embeds_initial, account_data)
+            await context.edit_original_response(embeds=embeds_full)
 
 #--------------------------------------------------------------------------
 @tree.command(
@@ -207,20 +412,52 @@ async def topweapons(context: discord.Interaction, name: str, tag: int):
     description="Get stats and information from last activity of a player"
 )
 @discord.app_commands.describe(
-    name="Destiny username",
+    name="Destiny username, or name#tag",
     tag="The four digits after the '#'"
 )
-async def lastactivity(context: discord.Interaction, name: str, tag: int):
-    loading_embed = await asyncio.to_thread(get_loading_embed, "lastactivity", name.lower(), tag)
+@discord.app_commands.autocomplete(name=name_autocomplete)
+async def lastactivity(context: discord.Interaction, name: str, tag: int = None):
+    name, tag = split_bungie_name(name, tag)
+    if tag is None:
+        await context.response.send_message("Give the tag as name#tag or in the tag option!", ephemeral=True)
+        return
+    loading_embed = get_loading_embed("lastactivity", name.lower(), tag)
     await context.response.send_message(embed=loading_embed)
-    embeds_initial, account_data = await asyncio.to_thread(get_account_data_embeds_activity, name.lower(), str(tag))
-    if embeds_initial is None:
-        await context.delete_original_response()
-        await context.followup.send("User was not found!", ephemeral=True)
-    else:
-        await context.edit_original_response(embeds=embeds_initial)
-        embeds_full = await asyncio.to_thread(get_last_activity_embeds, embeds_initial, account_data)
-        await context.edit_original_response(embeds=embeds_full)
+    with netreq.deadline(command_budgets["lastactivity"]):
+        embeds_initial, account_data = await get_account_data_embeds_activity(name.lower(), str(tag))
+        if embeds_initial is None:
+            await context.delete_original_response()
+            await context.followup.send("User was not found!", ephemeral=True)
+        else:
+            await context.edit_original_response(embeds=embeds_initial)
+            embeds_full = await get_last_activity_embeds(embeds_initial, account_data)
+            await context.edit_original_response(embeds=embeds_full)
+
+#--------------------------------------------------------------------------
+@tree.command(
+    name="stats",
+    description="See runtime statistics of Robin D. Estiny (owner only)"
+)
+async def stats(context: discord.Interaction):
+    if context.user.id != client.application.owner.id:
+        await context.response.send_message("Only the bot owner can see stats!", ephemeral=True)
+        return
+    #disk cache totals are read from SQLite, in a worker thread so the event loop is not blocked
+    await context.response.defer(ephemeral=True)
+    embed = await asyncio.to_thread(get_stats_embed, get_executor_stats())
+    await context.followup.send(embed=embed, ephemeral=True)
+
+#--------------------------------------------------------------------------
+@tree.command(
+    name="rollback",
+    description="Go back to the previous weekly and daily data (owner only)"
+)
+async def rollback(context: discord.Interaction):
+    if context.user.id != client.application.owner.id:
+        await context.response.send_message("Only the bot owner can roll back data!", ephemeral=True)
+        return
+    await context.response.defer(ephemeral=True)
+    await context.followup.send(await asyncio.to_thread(rollback_destiny_data_now), ephemeral=True)
 
 #--------------------------------------------------------------------------
 @tree.command(
@@ -244,9 +481,17 @@ if __name__ == "__main__":
     #setup destiny data
     if not setup_destiny_data():
         exit(-1)
+    render_static_responses()
 
     #run setup every hour to check for daily/weekly resets
-    schedule.every().hour.at(":01").do(setup_destiny_data)
+    schedule.every().hour.at(":01").do(run_job, refresh_destiny_data)
+    #proactively drop outdated cached responses
+    schedule.every().minute.do(run_job, netreq.expire_cache)
+    schedule.every().minute.do(run_job, expire_destiny_caches)
+    #keep names for autocomplete between restarts
+    schedule.every().minute.do(run_job, save_name_index)
+    #metrics file for a Prometheus textfile collector
+    schedule.every().minute.do(run_job, write_metrics)
     thread = threading.Thread(target=run_scheduler, daemon=True)
     thread.start()
 
@@ -0,0 +1,403 @@
+import os
+import time
+import zlib
+import heapq
+import sqlite3
+import threading
+from collections import OrderedDict
+
+PRIORITY_LOW = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+SCHEMA_VERSION = 2 #raised when a stored table layout changes, older tables are dropped and start empty
+ACCESS_RESOLUTION = 3600 #in seconds, how outdated the last read time of a stored entry may get before it is written
+
+def create_table(conn: sqlite3.Connection, table: str, columns: str) -> None:
+    """
+    Creates a table of cached data if missing, replacing it if created by an older layout.
+    Blobs go in the last column so sums and ordered scans over the other columns skip their overflow pages
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+class CacheEntry:
+    """
+    Cached value with its estimated size, expiry time and eviction priority
+    """
+    __slots__ = ("value", "size", "expires", "priority")
+
+    def __init__(self, value: object, size: int, expires: float, priority: int):
+        self.value = value
+        self.size = size
+        self.expires = expires
+        self.priority = priority
+
+class CacheShard:
+    """
+    Part of the cache with its own lock, LRU order per priority, expiry heap and byte budget
+    """
+    def __init__(self, max_bytes: int):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.orders = [OrderedDict() for _ in range(PRIORITY_HIGH + 1)] #least recently used first
+        self.expiry_heap = [] #(expiry time, key), may hold outdated pairs
+        self.bytes = 0
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def remove(self, key: str) -> CacheEntry:
+        """
+        Removes entry from shard, lock must be held
+        """
+        entry = self.entries.pop(key, None)
+        if entry:
+            del self.orders[entry.priority][key]
+            self.bytes -= entry.size
+        return entry
+
+    def evict(self) -> None:
+        """
+        Removes least recently used entries, lowest priority first, until under budget.
+        Lock must be held
+        """
+        for order in self.orders:
+            while self.bytes > self.max_bytes and order:
+                key, _ = order.popitem(last=False)
+                self.bytes -= self.entries.pop(key).size
+                self.evictions += 1
+
+    def expire(self, now: float) -> int:
+        """
+        Removes all entries that have passed their expiry time, lock must be held
+        """
+        removed = 0
+        heap = self.expiry_heap
+        while heap and heap[0][0] <= now:
+            expires, key = heapq.heappop(heap)
+            entry = self.entries.get(key)
+            if entry and entry.expires == expires: #ignore pairs for replaced entries
+                self.remove(key)
+                removed += 1
+        #drop outdated pairs left by evicted or replaced entries
+        if len(heap) > 4 * len(self.entries) + 64:
+            self.expiry_heap = [(e.expires, k) for k, e in self.entries.items()]
+            heapq.heapify(self.expiry_heap)
+        self.expirations += removed
+        return removed
+
+class LRUCache:
+    """
+    Thread-safe LRU cache with TTL expiry and a total byte budget.
+    Keys are spread over lock-striped shards so threads rarely wait on each other,
+    and every operation is O(1) apart from the amortized expiry heap upkeep.
+    Lower priority entries are evicted before higher priority ones
+    """
+    def __init__(self, max_bytes: int, ttl: float, shards: int = 16):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.shards = [CacheShard(max_bytes // shards) for _ in range(shards)]
+
+    def get_shard(self, key: str) -> CacheShard:
+        """
+        Gets the shard responsible for a key
+        """
+        return self.shards[hash(key) % len(self.shards)]
+
+    def get(self, key: str) -> object:
+        """
+        Gets value from cache, returns None if missing or expired
+        """
+        shard = self.get_shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key)
+            if entry is None:
+                shard.misses += 1
+                return None
+            if entry.expires <= time.monotonic():
+                shard.remove(key)
+                shard.expirations += 1
+                shard.misses += 1
+                return None
+            shard.orders[entry.priority].move_to_end(key)
+            shard.hits += 1
+            return entry.value
+
+    def put(self, key: str, value: object, size: int, ttl: float = None, priority: int = PRIORITY_NORMAL) -> bool:
+        """
+        Inserts value into cache, evicting least recently used entries if over budget.
+        Returns False if the value is too large to be cached
+        """
+        shard = self.get_shard(key)
+        if size > shard.max_bytes:
+            return False
+        now = time.monotonic()
+        expires = now + (self.ttl if ttl is None else ttl)
+        with shard.lock:
+            shard.remove(key)
+            shard.entries[key] = CacheEntry(value, size, expires, priority)
+            shard.orders[priority][key] = None
+            shard.bytes += size
+            heapq.heappush(shard.expiry_heap, (expires, key))
+            shard.expire(now)
+            shard.evict()
+        return True
+
+    def pop(self, key: str) -> object:
+        """
+        Removes key from cache, returns the removed value if any
+        """
+        shard = self.get_shard(key)
+        with shard.lock:
+            entry = shard.remove(key)
+        return entry.value if entry else None
+
+    def invalidate(self, predicate: callable) -> int:
+        """
+        Removes all entries whose key matches predicate, returns amount removed
+        """
+        removed = 0
+        for shard in self.shards:
+            with shard.lock:
+                for key in [key for key in shard.entries if predicate(key)]:
+                    shard.remove(key)
+                    removed += 1
+        return removed
+
+    def expire(self) -> int:
+        """
+        Removes all expired entries, returns amount removed
+        """
+        now = time.monotonic()
+        removed = 0
+        for shard in self.shards:
+            with shard.lock:
+                removed += shard.expire(now)
+        return removed
+
+    def clear(self) -> None:
+        """
+        Removes all entries
+        """
+        for shard in self.shards:
+            with shard.lock:
+                shard.entries.clear()
+                for order in shard.orders:
+                    order.clear()
+                shard.expiry_heap.clear()
+                shard.bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Gets entry, memory and hit/miss/eviction counts summed over all shards
+        """
+        stats = {
+            "entries": 0,
+            "bytes": 0,
+            "maxBytes": self.max_bytes,
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0
+        }
+        for shard in self.shards:
+            with shard.lock:
+                stats["entries"] += len(shard.entries)
+                stats["bytes"] += shard.bytes
+                stats["hits"] += shard.hits
+                stats["misses"] += shard.misses
+                stats["evictions"] += shard.evictions
+                stats["expirations"] += shard.expirations
+        lookups = stats["hits"] + stats["misses"]
+        stats["hitRatio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+class DiskCache:
+    """
+    Persistent response cache in a SQLite file that survives restarts.
+    Each thread gets its own connection, and WAL mode lets readers run alongside a writer
+    """
+    def __init__(self, filepath: str, max_bytes: int, max_age: float):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.max_age = max_age #how long stale entries are kept for revalidation
+        self.local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Gets the connection for the current thread, creating database if needed
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            conn = sqlite3.connect(self.filepath, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            create_table(
+                conn, "responses",
+                "key TEXT PRIMARY KEY, url TEXT NOT NULL, size INTEGER NOT NULL, " +
+                "etag TEXT, last_modified TEXT, expires REAL NOT NULL, stored REAL NOT NULL, body BLOB NOT NULL"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_stored ON responses (stored)")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key: str) -> tuple[bytes, str, str, float]:
+        """
+        Gets body, etag, last modified and expiry time (unix) of a stored response, None if missing
+        """
+        return self.connect().execute(
+            "SELECT body, etag, last_modified, expires FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+
+    def put(self, key: str, url: str, body: bytes, etag: str, last_modified: str, expires: float) -> None:
+        """
+        Stores a response with its validators
+        """
+        self.connect().execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, url, len(body), etag, last_modified, expires, time.time(), body)
+        )
+
+    def refresh(self, key: str, expires: float) -> None:
+        """
+        Marks a stored response as fresh again after the server confirmed it is unchanged
+        """
+        self.connect().execute(
+            "UPDATE responses SET expires = ?, stored = ? WHERE key = ?", (expires, time.time(), key)
+        )
+
+    def delete_url_prefix(self, prefix: str) -> int:
+        """
+        Removes all responses for urls starting with prefix, returns amount removed
+        """
+        cursor = self.connect().execute(
+            "DELETE FROM responses WHERE substr(url, 1, ?) = ?", (len(prefix), prefix)
+        )
+        return cursor.rowcount
+
+    def prune(self) -> int:
+        """
+        Removes expired responses that cannot be revalidated or are too old,
+        then the oldest responses until under the byte budget. Returns amount removed
+        """
+        now = time.time()
+        conn = self.connect()
+        removed = conn.execute(
+            "DELETE FROM responses WHERE expires < ? AND (stored < ? OR (etag IS NULL AND last_modified IS NULL))",
+            (now, now - self.max_age)
+        ).rowcount
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total > self.max_bytes:
+            over = total - self.max_bytes
+            for key, size in conn.execute("SELECT key, size FROM responses ORDER BY stored").fetchall():
+                if over <= 0:
+                    break
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                over -= size
+                removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Gets amount and total size of stored responses
+        """
+        entries, size = self.connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "maxBytes": self.max_bytes
+        }
+
+class CompressedStore:
+    """
+    Persistent store for responses that never change, compressed in a SQLite file.
+    Least recently read entries are removed first when over the byte budget
+    """
+    def __init__(self, filepath: str, max_bytes: int, level: int = 6):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.level = level #zlib compression level
+        self.local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Gets the connection for the current thread, creating database if needed
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            conn = sqlite3.connect(self.filepath, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            create_table(
+                conn, "entries",
+                "key INTEGER PRIMARY KEY, size INTEGER NOT NULL, raw_size INTEGER NOT NULL, accessed REAL NOT NULL, body BLOB NOT NULL"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)")
+            self.local.conn = conn
+        return conn
+
+    def get(self, key: int) -> bytes:
+        """
+        Gets stored data, None if missing.
+        The last read time is only written when outdated, so most reads do not write
+        """
+        conn = self.connect()
+        row = conn.execute("SELECT body, accessed FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[1] > ACCESS_RESOLUTION:
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return zlib.decompress(row[0])
+
+    def put(self, key: int, data: bytes) -> None:
+        """
+        Stores data compressed
+        """
+        body = zlib.compress(data, self.level)
+        self.connect().execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)", (key, len(body), len(data), time.time(), body)
+        )
+
+    def prune(self) -> int:
+        """
+        Removes least recently read entries until under the byte budget, returns amount removed
+        """
+        conn = self.connect()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        removed = 0
+        if total > self.max_bytes:
+            over = total - self.max_bytes
+            for key, size in conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+                if over <= 0:
+                    break
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                over -= size
+                removed += 1
+        return removed
+
+    def stats(self) -> dict:
+        """
+        Gets amount, compressed and uncompressed size of stored entries
+        """
+        entries, size, raw_size = self.connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(raw_size), 0) FROM entries"
+        ).fetchone()
+        return {
+            "entries": entries,
+            "bytes": size,
+            "rawBytes": raw_size,
+            "maxBytes": self.max_bytes
+        }
@@ -1,8 +1,20 @@
 import os
+import re
 import shutil
+import json
+import time
+import asyncio
+import contextvars
+from types import MappingProxyType
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from dotenv import get_key
-from src.netreq import do_retry_request
+from src.netreq import HttpResult, CachePolicy, IMMUTABLE, CACHE_TIMEOUT, do_retry_request, do_retry_request_async, set_disk_cache, invalidate_url_prefix, json_loads, deadline, DeadlineExceeded
+from src.cache import LRUCache, DiskCache, CompressedStore, PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH
+from src.manifest import ManifestDatabase
+from src.names import NameIndex
+from src import metrics
 from src.oauth import get_oauth_code, get_set_oauth, check_refresh_token
 from src.io import write_data_file, read_data_file, timestamp_print
 
@@ -15,12 +27,20 @@ HEADER = {
 }
 
 DATA_FOLDER = "data"
-RESETS_FILE = os.path.join(DATA_FOLDER, "resets.json")
-GM_FILE = os.path.join(DATA_FOLDER, "grandmaster.json")
-GM_DESTINATION_FILE = os.path.join(DATA_FOLDER, "gm_destination.json")
-GM_WEAPON_FILE = os.path.join(DATA_FOLDER, "gm_weapon.json")
-EVERVERSE_FOLDER = os.path.join(DATA_FOLDER, "eververse")
-RAID_DUNGEON_FOLDER = os.path.join(DATA_FOLDER, "raid_dungeon")
+GENERATIONS_FOLDER = os.path.join(DATA_FOLDER, "generations") #one folder per refresh of weekly and daily data
+GENERATION_FILE = os.path.join(DATA_FOLDER, "generation.json") #points at the published generation
+#weekly and daily data, relative to a generation folder
+RESETS_FILE = "resets.json"
+GM_FILE = "grandmaster.json"
+GM_DESTINATION_FILE = "gm_destination.json"
+GM_WEAPON_FILE = "gm_weapon.json"
+EVERVERSE_FOLDER = "eververse"
+RAID_DUNGEON_FOLDER = "raid_dungeon"
+HTTP_CACHE_FILE = os.path.join(DATA_FOLDER, "http_cache.sqlite")
+MANIFEST_FILE = os.path.join(DATA_FOLDER, "manifest.sqlite")
+ACCOUNT_CACHE_FILE = os.path.join(DATA_FOLDER, "accounts.sqlite")
+PGCR_STORE_FILE = os.path.join(DATA_FOLDER, "pgcr.sqlite")
+NAME_INDEX_FILE = os.path.join(DATA_FOLDER, "names.json")
 
 BRIGHT_DUST_URL = IMG_ROOT + "/common/destiny2_content/icons/555d03d9dde55e4015d76a67f1c763e2.png"
 KINETIC_URL = IMG_ROOT + "/common/destiny2_content/icons/DestinyDamageTypeDefinition_3385a924fd3ccb92c343ade19f19a370.png"
@@ -44,6 +64,42 @@ DUNGEON_URL = IMG_ROOT + "/common/destiny2_content/icons/b5c87175a97d1333da0ff43
 EVERVERSE_URL = IMG_ROOT + "/common/destiny2_content/icons/23163a74361c916f4446518aa53fd014.png"
 LZ_URL = IMG_ROOT + "/common/destiny2_content/icons/DestinyActivityModeDefinition_0aa1d7b0e0ac2c6820036b6b3dde3e5b.png"
 
+MANIFEST_WORKERS = 8 #concurrent requests for definitions missing from the local manifest
+ACCOUNT_CACHE_TTL = 24 * 3600 #in seconds, how long a resolved bungie name is reused
+ACCOUNT_NEGATIVE_TTL = 120 #in seconds, how long a bungie name that does not exist is remembered
+ACCOUNT_CACHE_MAX_BYTES = 8 * 1024 * 1024 #memory budget of resolved bungie names
+PGCR_STORE_MAX_BYTES = 256 * 1024 * 1024 #disk budget of compressed post game carnage reports
+SEARCH_CACHE_TTL = 120 #in seconds, how long pages of player search results are reused
+SEARCH_CACHE_MAX_BYTES = 4 * 1024 * 1024 #memory budget of player search results
+SEARCH_PREFETCH_BUDGET = 15 #in seconds, time budget of loading the next search page in the background
+NAME_INDEX_MAX = 50000 #bungie names kept for autocomplete, least recently seen are dropped
+SETUP_WORKERS = 8 #concurrent requests while refreshing data, all still pass the shared rate limiter
+VENDOR_FILTER = 0 #DestinyVendorFilter for vendor requests, 0 for all items and 1 for only purchasable ones
+
+#keep cached bungie responses between restarts
+set_disk_cache(HTTP_CACHE_FILE)
+#local manifest definitions, filled by update_manifest
+manifest_db = ManifestDatabase(MANIFEST_FILE)
+#bungie name -> memberships, kept between restarts
+account_cache = LRUCache(ACCOUNT_CACHE_MAX_BYTES, ACCOUNT_CACHE_TTL)
+account_disk_cache = DiskCache(ACCOUNT_CACHE_FILE, 4 * ACCOUNT_CACHE_MAX_BYTES, ACCOUNT_CACHE_TTL)
+metrics.register_gauge("account_cache", account_cache.stats)
+#instance id -> post game carnage report, reports never change once the activity ended
+pgcr_store = CompressedStore(PGCR_STORE_FILE, PGCR_STORE_MAX_BYTES)
+metrics.register_gauge("pgcr_store", pgcr_store.stats)
+#(name prefix, page) -> users with destiny memberships and if there are more pages
+search_cache = LRUCache(SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL)
+metrics.register_gauge("search_cache", search_cache.stats)
+prefetch_tasks = set() #keeps background prefetches from being garbage collected
+#bungie names seen in resolved accounts, search results and reports, for autocomplete
+name_index = NameIndex(NAME_INDEX_FILE, NAME_INDEX_MAX)
+name_index.load()
+metrics.register_gauge("name_index", name_index.stats)
+#published and previous data generation names, loaded on first use
+generation = None
+#weekly and daily data of the published generation, replaced whole when a generation is published
+snapshot = None
+
 elements = {
     1: ("Kinetic", KINETIC_URL),
     2: ("Arc", ARC_URL),
@@ -72,6 +128,11 @@ component_types = {
     "VendorCategories": 401,
     "VendorSales": 402
 }
+#components of every profile request, add to these instead of making separate profile requests
+profile_components = [
+    component_types["Profiles"],
+    component_types["Characters"]
+]
 hashes = {
     "GMAlert": "3511848321",
     "VanguardArms": "153857624",
@@ -92,58 +153,375 @@ eververse_vendors = [
     "2041776156", #shaders
     "213864513", #transmat effects
 ]
+#definition types stored in the local manifest, others are requested per hash
+manifest_entries = [
+    "InventoryItem",
+    "Activity",
+    "Destination"
+]
 classes = {
     671679327 : "Hunter",
     2271682572 : "Warlock",
     3655393761 : "Titan"
 }
+pgcr_pattern = re.compile(r"/Destiny2/Stats/PostGameCarnageReport/(\d+)/")
+#cache policy per route, first matching pattern is used
+cache_policies = [
+    (pgcr_pattern, #kept in pgcr_store, only briefly in memory
+        CachePolicy("pgcr", 60, PRIORITY_LOW, "large")),
+    (re.compile(r"/Destiny2/Manifest/Destiny\w+Definition/"), #only changes with the manifest version
+        CachePolicy("manifestDefinition", IMMUTABLE, PRIORITY_HIGH, "small", persist=True)),
+    (re.compile(r"/Destiny2/Manifest/$"),
+        CachePolicy("manifest", 300, PRIORITY_NORMAL, "small")),
+    (re.compile(r"/Destiny2/SearchDestinyPlayerByBungieName/"), #cached per bungie name in account_cache
+        CachePolicy("playerSearch", None)),
+    (re.compile(r"/User/Search/GlobalName/"), #cached per name prefix and page in search_cache
+        CachePolicy("nameSearch", None)),
+    (re.compile(r"/Destiny2/-?\d+/Account/-?\d+/Character/\d+/Stats/UniqueWeapons/"),
+        CachePolicy("uniqueWeapons", 900, PRIORITY_NORMAL, "medium", persist=True)),
+    (re.compile(r"/Destiny2/-?\d+/Account/-?\d+/Character/\d+/Stats/Activities/"), #live data
+        CachePolicy("activityHistory", 15, PRIORITY_LOW, "medium")),
+    (re.compile(r"/Destiny2/-?\d+/Profile/-?\d+/Character/\d+/"), #oauth character and vendor data for refreshes
+        CachePolicy("character", None)),
+    (re.compile(r"/Destiny2/-?\d+/Profile/-?\d+/"), #live data
+        CachePolicy("profile", 30, PRIORITY_LOW, "medium")),
+    (re.compile(r"/Destiny2/Milestones/"),
+        CachePolicy("milestones", None))
+]
+default_cache_policy = CachePolicy("other", CACHE_TIMEOUT)
 
-def get_request_response(path: str, cache: bool = True) -> object:
+def get_cache_policy(path: str) -> CachePolicy:
     """
-    Get response from GET request to bungie API
+    Gets cache policy for a bungie API path
     """
-    data = do_retry_request(cache, True, ROOT + path, HEADER)
-    if "Response" not in data.json():
+    for pattern, policy in cache_policies:
+        if pattern.match(path):
+            return policy
+    return default_cache_policy
+
+def get_response_payload(data: HttpResult) -> object:
+    """
+    Gets the Response part of a decoded bungie API result, None if missing
+    """
+    payload = data.json()
+    if not isinstance(payload, dict) or "Response" not in payload:
         return None
-    return data.json()["Response"]
+    return payload["Response"]
+
+def lookup_pgcr_store(path: str) -> tuple[int, object]:
+    """
+    Gets instance id of a post game carnage report path and the stored report if any,
+    instance id is None for other paths
+    """
+    match = pgcr_pattern.match(path)
+    if not match:
+        return None, None
+    instance_id = int(match[1])
+    body = pgcr_store.get(instance_id)
+    metrics.inc("pgcr_store_lookups_total", {"result": "hit" if body else "miss"})
+    return instance_id, json_loads(body) if body else None
+
+def store_pgcr(instance_id: int, report: object) -> None:
+    """
+    Stores a post game carnage report compressed
+    """
+    pgcr_store.put(instance_id, json.dumps(report, separators=(",", ":")).encode())
+    index_names(entry["player"]["destinyUserInfo"] for entry in report.get("entries", []))
 
-def post_request_response(path: str, payload: object, cache: bool = True) -> object:
+def get_request_response(path: str) -> object:
+    """
+    Get response from GET request to bungie API
+    """
+    instance_id, report = lookup_pgcr_store(path)
+    if report is not None:
+        return report
+    data = do_retry_request(get_cache_policy(path), True, ROOT + path, HEADER)
+    response = get_response_payload(data)
+    if instance_id and data and response is not None:
+        store_pgcr(instance_id, response)
+    return response
+
+def post_request_response(path: str, payload: object) -> object:
     """
     Get response from POST request to bungie API
     """
-    data = do_retry_request(cache, False, ROOT + path, HEADER, payload)
-    if "Response" not in data.json():
-        return None
-    return data.json()["Response"]
+    data = do_retry_request(get_cache_policy(path), False, ROOT + path, HEADER, payload)
+    return get_response_payload(data)
 
 def get_manifest_data(entry: str, hash: int) -> object:
     """
-    Gets data from manifest
+    Gets data from manifest, from the local manifest if stored there
     """
-    data = get_request_response(f"/Destiny2/Manifest/Destiny{entry}Definition/{hash}/")
+    data = manifest_db.get(entry, hash)
+    if data is None:
+        data = get_request_response(f"/Destiny2/Manifest/Destiny{entry}Definition/{hash}/")
     return data
 
-def get_request_response_oauth(path: str, access_token: str, cache: bool = True) -> object:
+def get_manifest_data_many(entry: str, hashes: list) -> dict:
+    """
+    Gets data from manifest for many hashes, keyed by hash, leaving out hashes not found.
+    Repeated hashes are resolved once, stored ones with one local query and the rest with concurrent requests
+    """
+    data = manifest_db.get_many(entry, set(hashes))
+    missing = [hash for hash in set(hashes) if hash not in data]
+    if missing:
+        #pool workers run each lookup in a copy of the caller's context so they keep its deadline
+        contexts = [contextvars.copy_context() for _ in missing]
+        with ThreadPoolExecutor(max_workers=min(len(missing), MANIFEST_WORKERS)) as pool:
+            responses = pool.map(
+                lambda context, hash: context.run(get_request_response, f"/Destiny2/Manifest/Destiny{entry}Definition/{hash}/"),
+                contexts, missing
+            )
+            data.update((hash, response) for hash, response in zip(missing, responses) if response is not None)
+    return data
+
+def get_request_response_oauth(path: str, access_token: str) -> object:
     """
     Get response from GET request with OAuth requirement with access key and components
     """
     header = {**HEADER, **{"Authorization": "Bearer " + access_token}}
-    data = do_retry_request(cache, True, ROOT + path, header)
-    if "Response" not in data.json():
-        return None
-    return data.json()["Response"]
+    data = do_retry_request(get_cache_policy(path), True, ROOT + path, header)
+    return get_response_payload(data)
+
+async def get_request_response_async(path: str) -> object:
+    """
+    Get response from GET request to bungie API without blocking the event loop
+    """
+    instance_id, report = None, None
+    if pgcr_pattern.match(path): #reading and decompressing a stored report runs in a worker thread
+        instance_id, report = await asyncio.to_thread(lookup_pgcr_store, path)
+    if report is not None:
+        return report
+    data = await do_retry_request_async(get_cache_policy(path), True, ROOT + path, HEADER)
+    response = get_response_payload(data)
+    if instance_id and data and response is not None:
+        await asyncio.to_thread(store_pgcr, instance_id, response) #encoding and compressing a report takes a few ms
+    return response
+
+async def post_request_response_async(path: str, payload: object) -> object:
+    """
+    Get response from POST request to bungie API without blocking the event loop
+    """
+    data = await do_retry_request_async(get_cache_policy(path), False, ROOT + path, HEADER, payload)
+    return get_response_payload(data)
+
+async def get_manifest_data_async(entry: str, hash: int) -> object:
+    """
+    Gets data from manifest without blocking the event loop, from the local manifest if stored there
+    """
+    data = manifest_db.get(entry, hash) #indexed lookup, fast enough to run on the loop
+    if data is None:
+        data = await get_request_response_async(f"/Destiny2/Manifest/Destiny{entry}Definition/{hash}/")
+    return data
+
+async def get_manifest_data_many_async(entry: str, hashes: list) -> dict:
+    """
+    Gets data from manifest for many hashes without blocking the event loop, keyed by hash,
+    leaving out hashes not found. Repeated hashes are resolved once, stored ones with one local query and the rest concurrently
+    """
+    data = manifest_db.get_many(entry, set(hashes))
+    missing = [hash for hash in set(hashes) if hash not in data]
+    if missing:
+        responses = await asyncio.gather(*(get_request_response_async(f"/Destiny2/Manifest/Destiny{entry}Definition/{hash}/") for hash in missing))
+        data.update((hash, response) for hash, response in zip(missing, responses) if response is not None)
+    return data
+
+async def get_request_response_oauth_async(path: str, access_token: str) -> object:
+    """
+    Get response from GET request with OAuth requirement without blocking the event loop
+    """
+    header = {**HEADER, **{"Authorization": "Bearer " + access_token}}
+    data = await do_retry_request_async(get_cache_policy(path), True, ROOT + path, header)
+    return get_response_payload(data)
+
+def update_manifest() -> bool:
+    """
+    Checks the manifest version and when it changed rebuilds only the stored definition
+    types whose content changed, and drops cached responses for all changed types.
+    Returns boolean indicating if the local manifest is up to date
+    """
+    manifest = get_request_response("/Destiny2/Manifest/")
+    if not manifest:
+        return False
+    version = manifest["version"]
+    if manifest_db.get_version() == version and all(manifest_db.has_table(entry) for entry in manifest_entries):
+        return True
+
+    timestamp_print(f"  Updating manifest to {version}...")
+    paths = manifest["jsonWorldComponentContentPaths"]["en"]
+    old_paths = manifest_db.get_paths()
+    for definition, path in paths.items():
+        entry = definition.removeprefix("Destiny").removesuffix("Definition")
+        stored = entry not in manifest_entries or manifest_db.has_table(entry)
+        if old_paths.get(entry) == path and stored:
+            continue
+        if entry in manifest_entries:
+            timestamp_print(f"    Rebuilding {entry}...")
+            data = do_retry_request(None, True, IMG_ROOT + path, None)
+            if not data:
+                timestamp_print(f"    Failed getting {entry} definitions")
+                return False
+            manifest_db.replace_table(entry, path, data.json())
+        else:
+            manifest_db.set_path(entry, path)
+        if entry in old_paths: #responses cached for the previous version are outdated
+            invalidate_url_prefix(f"{ROOT}/Destiny2/Manifest/{definition}/")
+    manifest_db.set_version(version)
+    timestamp_print("    Manifest updated")
+    return True
+
+def get_eververse_sales(vendors_data: object) -> list[object]:
+    """
+    Gets the sale items of the enabled eververse bright dust rotators from all vendors data of a character
+    """
+    sales = []
+    for vendor_hash in eververse_vendors:
+        vendor = vendors_data["vendors"]["data"].get(vendor_hash)
+        if not vendor or not vendor["enabled"]:
+            continue
+        sale_items = vendors_data["sales"]["data"][vendor_hash]["saleItems"]
+        for category in vendors_data["categories"]["data"][vendor_hash]["categories"]:
+            for item_idx in category["itemIndexes"]:
+                sales.append(sale_items[str(item_idx)])
+    return sales
+
+@contextmanager
+def setup_phase(name: str):
+    """
+    Times a phase of the data refresh, printing and recording its duration
+    """
+    start = time.perf_counter()
+    with metrics.timer("setup_phase_seconds", {"phase": name}):
+        yield
+    timestamp_print(f"    Took {time.perf_counter() - start:.2f}s ({name})")
+
+def get_generation() -> dict:
+    """
+    Gets names of the published and previous data generations
+    """
+    global generation
+    if generation is None:
+        generation = read_data_file(GENERATION_FILE) or {"current": None, "previous": None}
+    return generation
+
+def get_data_path(name: str) -> str:
+    """
+    Gets path of a weekly or daily data file or folder in the published generation
+    """
+    return os.path.join(GENERATIONS_FOLDER, str(get_generation()["current"]), name)
+
+def stage_generation() -> str:
+    """
+    Creates a new generation folder for a refresh to write into, starting as a copy
+    of the published one. Returns its path
+    """
+    stage = os.path.join(GENERATIONS_FOLDER, datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f"))
+    current = get_data_path("")
+    if get_generation()["current"] and os.path.isdir(current):
+        shutil.copytree(current, stage)
+    else:
+        os.makedirs(stage)
+    return stage
+
+def publish_generation(name: str, previous: str) -> None:
+    """
+    Points readers at a generation with a single atomic file replace, then removes
+    all generations except it and previous, including stages left by failed refreshes
+    """
+    global generation
+    published = {"current": name, "previous": previous}
+    write_data_file(published, GENERATION_FILE)
+    generation = published
+    for folder in os.listdir(GENERATIONS_FOLDER):
+        if folder not in published.values():
+            shutil.rmtree(os.path.join(GENERATIONS_FOLDER, folder), ignore_errors=True)
+
+def rollback_destiny_data() -> bool:
+    """
+    Publishes the previous generation of weekly and daily data again.
+    Returns boolean indicating if there was one to go back to
+    """
+    current, previous = get_generation()["current"], get_generation()["previous"]
+    #resets are written last, a generation without them is incomplete
+    if not previous or not os.path.isfile(os.path.join(GENERATIONS_FOLDER, previous, RESETS_FILE)):
+        return False
+    publish_generation(previous, current)
+    get_snapshot()
+    timestamp_print(f"Rolled back destiny data to {previous}")
+    return True
+
+def format_date(isotime: str) -> str:
+    """
+    Formats an iso timestamp as a date for display
+    """
+    return datetime.fromisoformat(isotime.replace("Z", "+00:00")).date().strftime("%a, %d %b %Y")
+
+class DataSnapshot:
+    """
+    Weekly and daily data of one generation, read from disk once and indexed for the
+    commands showing it. Never changed after loading, a new snapshot replaces it instead
+    """
+    __slots__ = (
+        "generation", "gm", "gm_destination", "gm_weapon", "raids", "dungeons",
+        "eververse_items", "eververse_categories", "current_week_date", "reset_week_date", "current_eververse_day"
+    )
+
+    def __init__(self, generation: str):
+        folder = os.path.join(GENERATIONS_FOLDER, generation)
+        self.generation = generation
+        self.gm = read_data_file(os.path.join(folder, GM_FILE))
+        self.gm_destination = read_data_file(os.path.join(folder, GM_DESTINATION_FILE))
+        self.gm_weapon = read_data_file(os.path.join(folder, GM_WEAPON_FILE))
+
+        #separate into raids and dungeons
+        raids = []
+        dungeons = []
+        raid_dungeon_folder = os.path.join(folder, RAID_DUNGEON_FOLDER)
+        for filename in sorted(os.listdir(raid_dungeon_folder)):
+            activity_data = read_data_file(os.path.join(raid_dungeon_folder, filename))
+            if str(activity_data["activityTypeHash"]) == hashes["Raid"]:
+                raids.append(activity_data)
+            else:
+                dungeons.append(activity_data)
+        self.raids = tuple(raids)
+        self.dungeons = tuple(dungeons)
+
+        #eververse items per type of cosmetic
+        items = {}
+        eververse_folder = os.path.join(folder, EVERVERSE_FOLDER)
+        for filename in sorted(os.listdir(eververse_folder)):
+            item_data = read_data_file(os.path.join(eververse_folder, filename))
+            items.setdefault(item_data["itemTypeDisplayName"], []).append(item_data)
+        self.eververse_items = MappingProxyType({category: tuple(category_items) for category, category_items in items.items()})
+        self.eververse_categories = tuple(sorted(items, key=lambda c : " ".join(c.split(" ")[::-1]) if "Ornament" in c else c)) #group ornaments together
+
+        #time periods
+        resets_data = read_data_file(os.path.join(folder, RESETS_FILE))
+        self.current_week_date = format_date(resets_data["currentDateWeekly"])
+        self.reset_week_date = format_date(resets_data["weeklyReset"])
+        self.current_eververse_day = format_date(resets_data["currentDateDaily"])
+
+def get_snapshot() -> DataSnapshot:
+    """
+    Gets the weekly and daily data of the published generation, loading it if a new one was published
+    """
+    global snapshot
+    current = get_generation()["current"]
+    if snapshot is None or snapshot.generation != current:
+        snapshot = DataSnapshot(current)
+    return snapshot
 
 def data_incomplete() -> bool:
     """
     Checks if all weekly and daily data exists
     """
-    if (not os.path.isdir(DATA_FOLDER) or
-        not os.path.isfile(RESETS_FILE) or
-        not os.path.isfile(GM_FILE) or
-        not os.path.isfile(GM_DESTINATION_FILE) or
-        not os.path.isfile(GM_WEAPON_FILE) or
-        not os.path.isdir(EVERVERSE_FOLDER) or
-        not os.path.isdir(RAID_DUNGEON_FOLDER)):
+    if (not get_generation()["current"] or
+        not os.path.isfile(get_data_path(RESETS_FILE)) or
+        not os.path.isfile(get_data_path(GM_FILE)) or
+        not os.path.isfile(get_data_path(GM_DESTINATION_FILE)) or
+        not os.path.isfile(get_data_path(GM_WEAPON_FILE)) or
+        not os.path.isdir(get_data_path(EVERVERSE_FOLDER)) or
+        not os.path.isdir(get_data_path(RAID_DUNGEON_FOLDER))):
         return True
     return False
 
@@ -152,7 +530,7 @@ def weekly_data_outdated() -> bool:
     Checks if weekly reset has been passed,
     signalling that all data is outdated
     """
-    resets_data = read_data_file(RESETS_FILE)
+    resets_data = read_data_file(get_data_path(RESETS_FILE))
     if not resets_data:
         return True
     weekly_reset_time = datetime.fromisoformat(resets_data["weeklyReset"].replace("Z", "+00:00"))
@@ -165,7 +543,7 @@ def daily_data_outdated() -> bool:
     Checks if daily reset has been passed,
     signaling that only daily data needs to be refreshed
     """
-    resets_data = read_data_file(RESETS_FILE)
+    resets_data = read_data_file(get_data_path(RESETS_FILE))
     if not resets_data:
         return True
     daily_reset_time = datetime.fromisoformat(resets_data["dailyReset"].replace("Z", "+00:00"))
@@ -180,6 +558,9 @@ def setup_destiny_data() -> bool:
     """
     timestamp_print("Setting up destiny data...")
 
+    with setup_phase("manifest"):
+        update_manifest() #definitions are requested per hash if this fails
+
     incomplete = data_incomplete()
     weekly_reset = weekly_data_outdated()
     daily_reset = daily_data_outdated()
@@ -203,7 +584,9 @@ def setup_destiny_data() -> bool:
             "titan": get_key(".env", "TITAN_ID")
         }
 
-        reset_data = read_data_file(RESETS_FILE)
+        #write into a copy of the published data, readers keep seeing it until the refresh is done
+        stage = stage_generation()
+        reset_data = read_data_file(os.path.join(stage, RESETS_FILE))
         if not reset_data:
             reset_data = {
                 "weeklyReset": "",
@@ -221,155 +604,328 @@ def setup_destiny_data() -> bool:
             access_token = get_set_oauth()
         if access_token is None:
             timestamp_print("    Failed getting access token")
+            shutil.rmtree(stage, ignore_errors=True)
             return False
         timestamp_print("    Access token acquired")
 
         timestamp_print("Gathering data from Bungie.Net API:")
-
-        # WEEKLY RESET OR INCOMPLETE BELOW
-
-        if incomplete or weekly_reset:
-            #clear featured folder
-            if os.path.isdir(RAID_DUNGEON_FOLDER):
-                shutil.rmtree(RAID_DUNGEON_FOLDER)
-                os.mkdir(RAID_DUNGEON_FOLDER)
-
-            #grandmaster.json
-            timestamp_print("  Getting grandmaster...")
-            character_data = get_request_response_oauth(f"/Destiny2/{m_type}/Profile/{m_id}/Character/{ch_ids['titan']}/" + #i dont play titan
-                                                        f"?components={component_types['CharacterActivities']}", access_token, False)
-            activities = character_data["activities"]["data"]["availableActivities"]
-            found = False
-            for activity in activities:
-                if (
-                    "challenges" not in activity or
-                    not activity["challenges"]
-                ):
-                    continue
-                #activity has challenges
-                for challenge in activity["challenges"]:
-                    objective_hash = challenge["objective"]["objectiveHash"]
-                    if str(objective_hash) == hashes["GMAlert"]:
-                        #a listed challenge objective is GM alert
-                        nightfall_hash = activity["activityHash"]
-                        nightfall_data = get_manifest_data("Activity", nightfall_hash)
-                        found = True
-                        timestamp_print("    Found!")
-                        write_data_file(nightfall_data, GM_FILE)
-                        break
-                if found:
-                    break
-
-            if not found: #gm not found
-                timestamp_print("    Not found")
-                write_data_file({}, GM_FILE)
-                write_data_file({}, GM_DESTINATION_FILE)
-                write_data_file({}, GM_WEAPON_FILE)
-            else:
-                #gm_destination.json
-                timestamp_print("  Getting gm destination...")
-                destination_data = get_manifest_data("Destination", nightfall_data["destinationHash"])
-                write_data_file(destination_data, GM_DESTINATION_FILE)
-
-                #gm_weapon.json
-                timestamp_print("  Getting gm weapon...")
-                weapon_hash = activity["visibleRewards"][0]["rewardItems"][0]["itemQuantity"]["itemHash"]
-                weapon_data = get_manifest_data("InventoryItem", weapon_hash)
-                write_data_file(weapon_data, GM_WEAPON_FILE)
-
-            #raids and dungeons
-            timestamp_print("  Getting raids and dungeons...")
-            for activity in activities:
-                if "challenges" not in activity: #this fails if you have completed the featured already
-                    continue
-                activity_hash = activity["activityHash"]
-                activity_data = get_manifest_data("Activity", activity_hash)
-                activity_type_hash = activity_data["activityTypeHash"]
-                if str(activity_type_hash) in [hashes["Raid"], hashes["Dungeon"]]:
-                    if ((("selectionScreenDisplayProperties" in activity_data and activity_data["selectionScreenDisplayProperties"]["name"] != "Master") or
-                        "selectionScreenDisplayProperties" not in activity_data) and
-                        "(Epic)" not in activity_data["displayProperties"]["name"]): #filter out master and epic versions of raids+dungeons
-                        #get destination info and add into activity data
-                        destination_data = get_manifest_data("Destination", activity_data["destinationHash"])
-                        destination_name = destination_data["displayProperties"]["name"]
-                        activity_data["destinationName"] = destination_name
-                        write_data_file(activity_data, os.path.join(RAID_DUNGEON_FOLDER, f"{activity_hash}.json"))
-
-            #reset.json weekly reset, for checking if up to date in the future
-            timestamp_print("  Getting next weekly reset...")
-            milestones_data = get_request_response("/Destiny2/Milestones/", False)
-            first = list(milestones_data)[0]
-            weekly_end_date = milestones_data[first]["endDate"]
-            reset_data["weeklyReset"] = weekly_end_date
-            reset_data["currentDateWeekly"] = (datetime.fromisoformat(weekly_end_date) - timedelta(weeks=1)).isoformat(timespec="seconds")
+        with ThreadPoolExecutor(max_workers=SETUP_WORKERS) as pool:
+            if incomplete or weekly_reset:
+                milestones_future = pool.submit(get_request_response, "/Destiny2/Milestones/")
+            #vendor data does not depend on weekly data, request it alongside, all vendors at once per character
+            vendor_futures = [
+                pool.submit(get_request_response_oauth, f"/Destiny2/{m_type}/Profile/{m_id}/Character/{ch_id}/Vendors/" +
+                            f"?components={component_types['Vendors']},{component_types['VendorCategories']}," +
+                            f"{component_types['VendorSales']}&filter={VENDOR_FILTER}", access_token)
+                for ch_id in ch_ids.values()
+            ]
+
+            # WEEKLY RESET OR INCOMPLETE BELOW
+
+            if incomplete or weekly_reset:
+                #clear featured folder
+                shutil.rmtree(os.path.join(stage, RAID_DUNGEON_FOLDER), ignore_errors=True)
+                os.mkdir(os.path.join(stage, RAID_DUNGEON_FOLDER))
+
+                #grandmaster.json
+                timestamp_print("  Getting grandmaster...")
+                with setup_phase("grandmaster"):
+                    character_data = get_request_response_oauth(f"/Destiny2/{m_type}/Profile/{m_id}/Character/{ch_ids['titan']}/" + #i dont play titan
+                                                                f"?components={component_types['CharacterActivities']}", access_token)
+                    activities = character_data["activities"]["data"]["availableActivities"]
+                    found = False
+                    for activity in activities:
+                        if (
+                            "challenges" not in activity or
+                            not activity["challenges"]
+                        ):
+                            continue
+                        #activity has challenges
+                        for challenge in activity["challenges"]:
+                            objective_hash = challenge["objective"]["objectiveHash"]
+                            if str(objective_hash) == hashes["GMAlert"]:
+                                #a listed challenge objective is GM alert
+                                nightfall_hash = activity["activityHash"]
+                                nightfall_data = get_manifest_data("Activity", nightfall_hash)
+                                found = True
+                                timestamp_print("    Found!")
+                                write_data_file(nightfall_data, os.path.join(stage, GM_FILE))
+                                break
+                        if found:
+                            break
+
+                    if not found: #gm not found
+                        timestamp_print("    Not found")
+                        write_data_file({}, os.path.join(stage, GM_FILE))
+                        write_data_file({}, os.path.join(stage, GM_DESTINATION_FILE))
+                        write_data_file({}, os.path.join(stage, GM_WEAPON_FILE))
+                    else:
+                        #gm_destination.json
+                        destination_data = get_manifest_data("Destination", nightfall_data["destinationHash"])
+                        write_data_file(destination_data, os.path.join(stage, GM_DESTINATION_FILE))
+
+                        #gm_weapon.json
+                        weapon_hash = activity["visibleRewards"][0]["rewardItems"][0]["itemQuantity"]["itemHash"]
+                        weapon_data = get_manifest_data("InventoryItem", weapon_hash)
+                        write_data_file(weapon_data, os.path.join(stage, GM_WEAPON_FILE))
+
+                #raids and dungeons
+                timestamp_print("  Getting raids and dungeons...")
+                with setup_phase("raids and dungeons"):
+                    featured_hashes = [activity["activityHash"] for activity in activities if "challenges" in activity] #this fails if you have completed the featured already
+                    featured_data = get_manifest_data_many("Activity", featured_hashes)
+                    raids_dungeons = {}
+                    for activity_hash in featured_hashes:
+                        activity_data = featured_data[activity_hash]
+                        activity_type_hash = activity_data["activityTypeHash"]
+                        if str(activity_type_hash) in [hashes["Raid"], hashes["Dungeon"]]:
+                            if ((("selectionScreenDisplayProperties" in activity_data and activity_data["selectionScreenDisplayProperties"]["name"] != "Master") or
+                                "selectionScreenDisplayProperties" not in activity_data) and
+                                "(Epic)" not in activity_data["displayProperties"]["name"]): #filter out master and epic versions of raids+dungeons
+                                raids_dungeons[activity_hash] = activity_data
+                    #get destination info and add into activity data
+                    destinations_data = get_manifest_data_many("Destination", [activity_data["destinationHash"] for activity_data in raids_dungeons.values()])
+                    for activity_hash, activity_data in raids_dungeons.items():
+                        destination_name = destinations_data[activity_data["destinationHash"]]["displayProperties"]["name"]
+                        activity_data = {**activity_data, "destinationName": destination_name} #copy since manifest data is shared with cache
+                        write_data_file(activity_data, os.path.join(stage, RAID_DUNGEON_FOLDER, f"{activity_hash}.json"))
+
+                #reset.json weekly reset, for checking if up to date in the future
+                timestamp_print("  Getting next weekly reset...")
+                with setup_phase("weekly reset"):
+                    milestones_data = milestones_future.result()
+                first = list(milestones_data)[0]
+                weekly_end_date = milestones_data[first]["endDate"]
+                reset_data["weeklyReset"] = weekly_end_date
+                reset_data["currentDateWeekly"] = (datetime.fromisoformat(weekly_end_date) - timedelta(weeks=1)).isoformat(timespec="seconds")
+
+            #eververse vendors of every character
+            timestamp_print("  Getting eververse...")
+            with setup_phase("eververse vendors"):
+                characters_vendors = [future.result() for future in vendor_futures]
 
         # DAILY RESET OR INCOMPLETE BELOW
 
         #clear eververse folder
-        if os.path.isdir(EVERVERSE_FOLDER):
-            shutil.rmtree(EVERVERSE_FOLDER)
-            os.mkdir(EVERVERSE_FOLDER)
+        shutil.rmtree(os.path.join(stage, EVERVERSE_FOLDER), ignore_errors=True)
+        os.mkdir(os.path.join(stage, EVERVERSE_FOLDER))
 
         #eververse weeklies
-        timestamp_print("  Getting eververse:")
-        gathered = [] #keep track of item hashes to ignore shared items
-        for key, ch_id in ch_ids.items():
-            timestamp_print(f"    {key.title()}...")
-
-            for vendor_hash in eververse_vendors:
-                #get vendor data
-                eververse_data = get_request_response_oauth(f"/Destiny2/{m_type}/Profile/{m_id}/Character/{ch_id}/Vendors/{vendor_hash}/" +
-                                    f"?components={component_types['VendorCategories']}," +
-                                    f"{component_types['VendorSales']}", access_token, False)
-                #write each item's data to a file
-                categories = eververse_data["categories"]["data"]["categories"]
-                for category in categories:
-                    for item_idx in category["itemIndexes"]:
-                        item = eververse_data["sales"]["data"][str(item_idx)]
-                        item_hash = item["itemHash"]
-                        price = item["costs"][0]["quantity"]
-                        if item_hash in gathered: #ignore shared items
-                            continue
-                        item_data = get_manifest_data("InventoryItem", item_hash)
-                        item_data["price"] = price #add bright dust price
-                        item_data
-                        if item_data["itemTypeDisplayName"] == "Consumable":
-                            continue
-                        gathered.append(item_hash)
-                        write_data_file(item_data, os.path.join(EVERVERSE_FOLDER, str(item_hash) + ".json"))
+        with setup_phase("eververse items"):
+            sales = {} #item hash -> bright dust price, shared items only once
+            inventories = set() #item hashes sold to characters already gone through
+            daily_end_date = None #all rotators refresh together at the daily reset
+            for vendors_data in characters_vendors:
+                character_sales = get_eververse_sales(vendors_data)
+                if daily_end_date is None:
+                    daily_end_date = next((item["overrideNextRefreshDate"] for item in character_sales if "overrideNextRefreshDate" in item), None)
+                inventory = frozenset(item["itemHash"] for item in character_sales)
+                if inventory in inventories: #same rotation as another character
+                    continue
+                inventories.add(inventory)
+                for item in character_sales:
+                    sales.setdefault(item["itemHash"], item["costs"][0]["quantity"])
+
+            #write each item's data to a file
+            items_data = get_manifest_data_many("InventoryItem", sales)
+            for item_hash, price in sales.items():
+                item_data = {**items_data[item_hash], "price": price} #add bright dust price, copy since manifest data is shared with cache
+                if item_data["itemTypeDisplayName"] == "Consumable":
+                    continue
+                write_data_file(item_data, os.path.join(stage, EVERVERSE_FOLDER, str(item_hash) + ".json"))
 
         #reset.json daily reset, for checking if up to date in the future
-        daily_end_date = item["overrideNextRefreshDate"]
+        if daily_end_date is None:
+            timestamp_print("    Failed getting daily reset from eververse")
+            shutil.rmtree(stage, ignore_errors=True)
+            return False
         reset_data["dailyReset"] = daily_end_date
         reset_data["currentDateDaily"] = (datetime.fromisoformat(daily_end_date) - timedelta(days=1)).isoformat(timespec="seconds")
 
         #write next weekly and daily reset times to file
-        write_data_file(reset_data, RESETS_FILE)
+        write_data_file(reset_data, os.path.join(stage, RESETS_FILE))
+
+        #swap in the refreshed data, keeping the previous generation for rollback
+        publish_generation(os.path.basename(stage), get_generation()["current"])
 
+    get_snapshot() #load published data before commands need it
     timestamp_print("Done!")
     return True
 
+def index_names(users: list[object]) -> None:
+    """
+    Adds bungie names of user infos or search results to the autocomplete index
+    """
+    for user in users:
+        name_index.add(user.get("bungieGlobalDisplayName"), user.get("bungieGlobalDisplayNameCode"))
+
+def search_names(prefix: str) -> list[str]:
+    """
+    Gets known bungie names with tags starting with prefix, for autocomplete
+    """
+    return name_index.search(prefix)
+
+def save_name_index() -> None:
+    """
+    Saves names added to the autocomplete index since the last save
+    """
+    name_index.save()
+
+def get_account_key(name: str, tag: int) -> str:
+    """
+    Gets cache key of a bungie name, names are not case sensitive
+    """
+    return f"{name.casefold()}#{str(tag).zfill(4)}"
+
+def lookup_account_cache(key: str) -> object:
+    """
+    Gets cached account data of a bungie name, an empty list if the name is known
+    not to exist and None if not cached
+    """
+    account_data = account_cache.get(key)
+    if account_data is None:
+        stored = account_disk_cache.get(key)
+        if stored and stored[3] > time.time():
+            account_data = json_loads(stored[0])
+            account_cache.put(key, account_data, len(stored[0]), stored[3] - time.time())
+    metrics.inc("account_cache_lookups_total", {"result": "miss" if account_data is None else ("hit" if account_data else "negative")})
+    return account_data
+
+def store_account_cache(key: str, account_data: object) -> None:
+    """
+    Caches account data of a bungie name, names not found for a shorter time
+    """
+    if account_data is None: #request failed, nothing learned about the name
+        return
+    index_names(account_data)
+    ttl = ACCOUNT_CACHE_TTL if account_data else ACCOUNT_NEGATIVE_TTL
+    body = json.dumps(account_data).encode()
+    account_cache.put(key, account_data, len(body), ttl)
+    account_disk_cache.put(key, key, body, None, None, time.time() + ttl)
+
+def expire_destiny_caches() -> int:
+    """
+    Removes outdated resolved bungie names and search results, and least recently read
+    reports over budget, returns amount removed
+    """
+    return account_cache.expire() + account_disk_cache.prune() + pgcr_store.prune() + search_cache.expire()
+
 def get_account_data(name: str, tag: int) -> object:
     """
     Gets account data from name and tag
     """
+    key = get_account_key(name, tag)
+    account_data = lookup_account_cache(key)
+    if account_data is not None:
+        return account_data
     info = {
         "displayName": name,
         "displayNameCode": tag
     }
     account_data = post_request_response("/Destiny2/SearchDestinyPlayerByBungieName/-1/", info)
+    store_account_cache(key, account_data)
+    return account_data
+
+async def get_account_data_async(name: str, tag: int) -> object:
+    """
+    Gets account data from name and tag without blocking the event loop,
+    the persisted account cache is read and written in a worker thread
+    """
+    key = get_account_key(name, tag)
+    account_data = await asyncio.to_thread(lookup_account_cache, key)
+    if account_data is not None:
+        return account_data
+    info = {
+        "displayName": name,
+        "displayNameCode": tag
+    }
+    account_data = await post_request_response_async("/Destiny2/SearchDestinyPlayerByBungieName/-1/", info)
+    await asyncio.to_thread(store_account_cache, key, account_data)
     return account_data
 
-def get_characters_data(type: int, id: str) -> object:
+def get_search_key(prefix: str, page: int) -> str:
+    """
+    Gets cache key of a page of player search results, names are not case sensitive
+    """
+    return f"{prefix.casefold()};{page}"
+
+def get_cached_search_page(prefix: str, page: int) -> tuple[list[object], bool]:
+    """
+    Gets a page of player search results if it can be shown without waiting on bungie, else None
+    """
+    return search_cache.get(get_search_key(prefix, page))
+
+async def search_players_async(prefix: str, page: int) -> tuple[list[object], bool]:
+    """
+    Gets users with destiny memberships on a page of results for a name prefix and if there
+    are more pages, without blocking the event loop. Returns None if the search failed
+    """
+    key = get_search_key(prefix, page)
+    page_data = search_cache.get(key)
+    if page_data is not None:
+        return page_data
+    payload = {
+        "displayNamePrefix": prefix
+    }
+    search_data = await post_request_response_async(f"/User/Search/GlobalName/{page}/", payload)
+    if not search_data:
+        return None
+    results = [s for s in search_data["searchResults"] if s["destinyMemberships"]]
+    index_names(results)
+    page_data = (results, search_data["hasMore"])
+    if results:
+        search_cache.put(key, page_data, 1024 * len(results)) #rough size of a user with memberships
+    return page_data
+
+async def prefetch_search_page_async(prefix: str, page: int) -> None:
+    """
+    Loads a page of player search results into the cache with its own time budget
+    """
+    with deadline(SEARCH_PREFETCH_BUDGET, detached=True):
+        try:
+            await search_players_async(prefix, page)
+        except DeadlineExceeded:
+            pass
+
+def prefetch_search_page(prefix: str, page: int) -> None:
+    """
+    Starts loading a page of player search results in the background if not cached
+    """
+    if get_cached_search_page(prefix, page) is not None:
+        return
+    task = asyncio.create_task(prefetch_search_page_async(prefix, page))
+    prefetch_tasks.add(task)
+    task.add_done_callback(prefetch_tasks.discard)
+
+class ProfileSnapshot:
+    """
+    Profile of one membership from a single request for all profile components commands use.
+    Components that were not requested or are private are empty
+    """
+    __slots__ = ("membership_type", "membership_id", "user_info", "character_ids", "characters")
+
+    def __init__(self, membership_type: int, membership_id: str, response: dict):
+        profile = response.get("profile", {}).get("data", {})
+        self.membership_type = membership_type
+        self.membership_id = membership_id
+        self.user_info = profile.get("userInfo", {})
+        self.characters = response.get("characters", {}).get("data", {}) #character id -> character
+        self.character_ids = profile.get("characterIds", list(self.characters))
+
+def get_profile_path(type: int, id: str) -> str:
+    """
+    Gets path of the profile request, the same for every command so the cached response is shared
+    """
+    return f"/Destiny2/{type}/Profile/{id}/?components={','.join(str(c) for c in profile_components)}"
+
+async def get_profile_async(type: int, id: str) -> ProfileSnapshot:
     """
-    Gets the characters for a given account
+    Gets the profile of a membership without blocking the event loop, None if not found
     """
-    response = get_request_response(f"/Destiny2/{type}/" +
-                                    f"Profile/{id}/" +
-                                    f"?components={component_types['Characters']}")
+    response = await get_request_response_async(get_profile_path(type, id))
     if not response:
         return None
-    return response["characters"]["data"]
+    return ProfileSnapshot(type, id, response)
 
 def get_rarity_color(item: object) -> tuple[int, int, int]:
     """
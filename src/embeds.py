@@ -1,10 +1,16 @@
-import os
+import asyncio
+import traceback
 from datetime import datetime, timedelta, timezone
 import src.destiny as destiny
-from src.io import read_data_file
+import src.netreq as netreq
+import src.metrics as metrics
+from src.io import timestamp_print
 from discord import Embed, Colour, ButtonStyle, Interaction
 from discord.ui import View, Button, Select
 
+FANOUT_LIMIT = 8 #most bungie requests one command makes at once
+TIMED_OUT = object() #result of a request that ran out of time
+
 class OwnedView(View):
     """
     View with stored owner
@@ -20,52 +26,123 @@ class OwnedView(View):
         await context.response.send_message("You can't interact with this message!", ephemeral=True)
         return False
 
+class RenderedResponse:
+    """
+    Response of a static command rendered once per data snapshot, with embeds kept as
+    serialized payloads and buttons as a template for the view of each user
+    """
+    __slots__ = ("embeds", "buttons")
+
+    def __init__(self, embeds: list[Embed], view: View = None):
+        self.embeds = tuple(embed.to_dict() for embed in embeds)
+        self.buttons = tuple(
+            {"style": button.style, "label": button.label, "custom_id": button.custom_id, "disabled": button.disabled}
+            for button in view.children
+        ) if view else ()
+
+    def get_embeds(self) -> list[Embed]:
+        """
+        Gets embeds from the serialized payloads
+        """
+        return [Embed.from_dict(payload) for payload in self.embeds]
+
+    def get_view(self, owner_id: int, callback: callable) -> OwnedView:
+        """
+        Gets view owned by a user with the buttons of the template
+        """
+        view = OwnedView(owner_id)
+        view.timeout = None
+        for template in self.buttons:
+            button = Button(**template)
+            button.callback = callback
+            view.add_item(button)
+        return view
+
+#data generation the responses were rendered for, (command, category) -> rendered response
+rendered = (None, {})
+
+def render_static_responses() -> None:
+    """
+    Renders gm, featured and every eververse category page for the current data snapshot.
+    Each response is rendered on its own, one that fails keeps its previously rendered version
+    """
+    global rendered
+    try:
+        snapshot = destiny.get_snapshot()
+    except Exception:
+        timestamp_print("Failed loading destiny data, keeping rendered responses")
+        traceback.print_exc()
+        return
+    builders = {
+        ("gm", None): lambda: RenderedResponse(get_gm_data_embeds()),
+        ("featured", None): lambda: RenderedResponse(get_featured_data_embeds())
+    }
+    for category in (None,) + snapshot.eververse_categories:
+        builders[("eververse", category)] = lambda category=category: RenderedResponse(*get_eververse_data_embeds(OwnedView(None), category))
+    responses = {}
+    for key, build in builders.items():
+        try:
+            responses[key] = build()
+        except Exception:
+            timestamp_print(f"Failed rendering {key[0]} {key[1] or ''}, keeping previous response")
+            traceback.print_exc()
+            if key in rendered[1]:
+                responses[key] = rendered[1][key]
+    rendered = (snapshot.generation, responses)
+
+def get_rendered_response(command: str, category: str = None) -> RenderedResponse:
+    """
+    Gets the last pre-rendered response of a static command, responses are rendered again
+    by whoever refreshes the data so commands never load data themselves.
+    Returns None if there is no such category or it could not be rendered
+    """
+    return rendered[1].get((command, category))
+
 def get_gm_data_embeds() -> list[Embed]:
     """
     Gets formatted embeds with grandmaster vanguard alert data
     """
     embeds = []
+    snapshot = destiny.get_snapshot()
 
     #add header with time period
-    dates_data = read_data_file(destiny.RESETS_FILE)
-    current_week_date = datetime.fromisoformat(dates_data["currentDateWeekly"]).date().strftime("%a, %d %b %Y")
-    reset_week_date = datetime.fromisoformat(dates_data["weeklyReset"]).date().strftime("%a, %d %b %Y")
     embeds.append(
         Embed(
             title="Weekly Grandmaster Vanguard Alert"
         )
-        .add_field(name="From: ", value=current_week_date, inline=True)
-        .add_field(name="Until: ", value=reset_week_date, inline=True)
+        .add_field(name="From: ", value=snapshot.current_week_date, inline=True)
+        .add_field(name="Until: ", value=snapshot.reset_week_date, inline=True)
     )
 
-    #nightfall weapon embed
-    weapon_data = destiny.read_data_file(destiny.GM_WEAPON_FILE)
-    weapon_name = weapon_data["displayProperties"]["name"]
-    weapon_url = destiny.IMG_ROOT + weapon_data["displayProperties"]["icon"]
-    weapon_description = weapon_data["flavorText"]
-    weapon_type = weapon_data["itemTypeDisplayName"]
-    weapon_element = weapon_data["defaultDamageType"]
-    embeds.append(
-        Embed(
-            title=weapon_name,
-            description=weapon_description
+    #nightfall weapon embed, empty if the grandmaster was not found
+    weapon_data = snapshot.gm_weapon
+    if weapon_data:
+        weapon_name = weapon_data["displayProperties"]["name"]
+        weapon_url = destiny.IMG_ROOT + weapon_data["displayProperties"]["icon"]
+        weapon_description = weapon_data["flavorText"]
+        weapon_type = weapon_data["itemTypeDisplayName"]
+        weapon_element = weapon_data["defaultDamageType"]
+        embeds.append(
+            Embed(
+                title=weapon_name,
+                description=weapon_description
+            )
+            .set_author(name="Weekly Bonus Weapon")
+            .set_thumbnail(url=weapon_url)
+            .set_footer(text=f"{destiny.elements[weapon_element][0]} {weapon_type}", icon_url=destiny.elements[weapon_element][1])
         )
-        .set_author(name="Weekly Bonus Weapon")
-        .set_thumbnail(url=weapon_url)
-        .set_footer(text=f"{destiny.elements[weapon_element][0]} {weapon_type}", icon_url=destiny.elements[weapon_element][1])
-    )
 
     #data from grandmaster.json
-    gm_data = destiny.read_data_file(destiny.GM_FILE)
+    gm_data = snapshot.gm
     if gm_data:
         gm_name = gm_data["originalDisplayProperties"]["name"]
         gm_description = gm_data["displayProperties"]["description"]
         gm_bg_url = destiny.IMG_ROOT + gm_data["pgcrImage"]
 
-        #data from gm_destination.json
-        destination_data = destiny.read_data_file(destiny.GM_DESTINATION_FILE)
-        dest_name = destination_data["displayProperties"]["name"]
-        dest_description = destination_data["displayProperties"]["description"]
+        #data from gm_destination.json, empty if the destination was not found
+        destination_properties = snapshot.gm_destination.get("displayProperties", {}) if snapshot.gm_destination else {}
+        dest_name = destination_properties.get("name", "")
+        dest_description = destination_properties.get("description", "")
 
         if len(dest_name) < 1:
             #backup names
@@ -94,21 +171,7 @@ def get_featured_data_embeds() -> list[Embed]:
     """
     Gets formatted embeds with all featured raids and dungeons
     """
-    #separate into raids and dungeons
-    raids = []
-    dungeons = []
-    directory = os.listdir(destiny.RAID_DUNGEON_FOLDER)
-    for filename in directory:
-        file_data = destiny.read_data_file(os.path.join(destiny.RAID_DUNGEON_FOLDER, filename))
-        if str(file_data["activityTypeHash"]) == destiny.hashes["Raid"]:
-            raids.append(file_data)
-        else:
-            dungeons.append(file_data)
-
-    #get the time period
-    dates_data = read_data_file(destiny.RESETS_FILE)
-    current_week_date = datetime.fromisoformat(dates_data["currentDateWeekly"]).date().strftime("%a, %d %b %Y")
-    reset_week_date = datetime.fromisoformat(dates_data["weeklyReset"]).date().strftime("%a, %d %b %Y")
+    snapshot = destiny.get_snapshot()
 
     #add each raid and dungeon embed
     embeds = []
@@ -116,10 +179,10 @@ def get_featured_data_embeds() -> list[Embed]:
         Embed(
             title="Weekly Featured Raids and Dungeons"
         )
-        .add_field(name="From: ", value=current_week_date, inline=True)
-        .add_field(name="Until: ", value=reset_week_date, inline=True)
+        .add_field(name="From: ", value=snapshot.current_week_date, inline=True)
+        .add_field(name="Until: ", value=snapshot.reset_week_date, inline=True)
     )
-    activities = raids + dungeons
+    activities = snapshot.raids + snapshot.dungeons
     for activity in activities:
         name = activity["originalDisplayProperties"]["name"]
         description = activity["originalDisplayProperties"]["description"]
@@ -147,13 +210,13 @@ def get_featured_data_embeds() -> list[Embed]:
         )
     return embeds
 
-def get_account_data_embeds_lookup(new_view: OwnedView, name: str, tag: int, type: int = None) -> tuple[list[Embed], OwnedView, int, str]:
+async def get_account_data_embeds_lookup(new_view: OwnedView, name: str, tag: int, type: int = None) -> tuple[list[Embed], OwnedView, int, str]:
     """
     Gets formatted embeds with account data from name and tag for lookup command
     Also returns membership type and id
     """
     #get account data
-    account_data = destiny.get_account_data(name, tag)
+    account_data = await destiny.get_account_data_async(name, tag)
     if not account_data:
         return None, None, None, None
 
@@ -208,14 +271,18 @@ def get_account_data_embeds_lookup(new_view: OwnedView, name: str, tag: int, typ
         )
     return embeds, view, membership_type, membership_id
 
-def get_character_data_embeds(initial: list[Embed], type: int, id: str) -> list[Embed]:
+async def get_character_data_embeds(initial: list[Embed], type: int, id: str) -> list[Embed]:
     """
     Gets formatted embeds for character data for an account
     """
     embeds = [initial[0]]
 
-    #get characters data
-    characters_data = destiny.get_characters_data(type, id)
+    #get characters data, the account embed is still shown if it runs out of time
+    try:
+        profile = await destiny.get_profile_async(type, id)
+    except netreq.DeadlineExceeded:
+        return embeds + [get_timeout_embed()]
+    characters_data = profile.characters if profile else None
     if not characters_data:
         return embeds + [Embed(title="No characters found!")]
 
@@ -227,47 +294,97 @@ def get_character_data_embeds(initial: list[Embed], type: int, id: str) -> list[
     )
 
     #start building embeds
-    for _, character in sorted_characters_data:
-        minutes = int(character["minutesPlayedTotal"])
-        guardian_class = destiny.classes[character["classHash"]]
-        power = character["light"]
-        emblem_url = destiny.IMG_ROOT + character["emblemPath"]
-
-        #get emblem background
-        emblem_hash = character["emblemHash"]
-        emblem_data = destiny.get_manifest_data("InventoryItem", emblem_hash)
-        emblem_bg_url = destiny.IMG_ROOT + emblem_data["secondarySpecial"]
-
-        #copy emblem color
-        r = character["emblemColor"]["red"]
-        g = character["emblemColor"]["green"]
-        b = character["emblemColor"]["blue"]
-
-        #time since last played
-        last = datetime.fromisoformat(character["dateLastPlayed"].replace("Z", "+00:00"))
-        now = datetime.now(timezone.utc)
-        time_session = int(character["minutesPlayedThisSession"]) #minutes played can be !=0 despite no session being active
-        session_start = now - timedelta(minutes=time_session)
-        if not time_session or session_start > last:
-            diff = format_timedelta(now - last)
-        else:
-            diff = "Now"
-
-        embeds.append(
-            Embed(
-                title=f"{power} | {guardian_class}",
-                #⣠⡾⠋⠙⢷⣄⣠⡾⠋⠙⢷⣄⣠⡾⠋⠙⢷⣄⣠⡾⠋⠙⢷⣄
-                #description="\u28e0\u287e\u280b\u2819\u28B7\u28C4\u28e0\u287e\u280b\u2819\u28B7\u28C4\u28e0\u287e\u280b\u2819\u28B7\u28C4\u28e0\u287e\u280b\u2819\u28B7\u28C4",
-                #description="\u2802"*24,
-                color=Colour.from_rgb(r, g, b)
+    try:
+        emblems_data = await destiny.get_manifest_data_many_async("InventoryItem", [character["emblemHash"] for _, character in sorted_characters_data])
+        for _, character in sorted_characters_data:
+            minutes = int(character["minutesPlayedTotal"])
+            guardian_class = destiny.classes[character["classHash"]]
+            power = character["light"]
+            emblem_url = destiny.IMG_ROOT + character["emblemPath"]
+
+            #get emblem background
+            emblem_data = emblems_data[character["emblemHash"]]
+            emblem_bg_url = destiny.IMG_ROOT + emblem_data["secondarySpecial"]
+
+            #copy emblem color
+            r = character["emblemColor"]["red"]
+            g = character["emblemColor"]["green"]
+            b = character["emblemColor"]["blue"]
+
+            #time since last played
+            last = datetime.fromisoformat(character["dateLastPlayed"].replace("Z", "+00:00"))
+            now = datetime.now(timezone.utc)
+            time_session = int(character["minutesPlayedThisSession"]) #minutes played can be !=0 despite no session being active
+            session_start = now - timedelta(minutes=time_session)
+            if not time_session or session_start > last:
+                diff = format_timedelta(now - last)
+            else:
+                diff = "Now"
+
+            embeds.append(
+                Embed(
+                    title=f"{power} | {guardian_class}",
+                    #⣠⡾⠋⠙⢷⣄⣠⡾⠋⠙⢷⣄⣠⡾⠋⠙⢷⣄⣠⡾⠋⠙⢷⣄
+                    #description="\u28e0\u287e\u280b\u2819\u28B7\u28C4\u28e0\u287e\u280b\u2819\u28B7\u28C4\u28e0\u287e\u280b\u2819\u28B7\u28C4\u28e0\u287e\u280b\u2819\u28B7\u28C4",
+                    #description="\u2802"*24,
+                    color=Colour.from_rgb(r, g, b)
+                )
+                .add_field(name="Total time played", value=f"{minutes//60}h {minutes%60}m", inline=False)
+                .add_field(name="Time since last played", value=diff, inline=False)
+                .set_thumbnail(url=emblem_url)
+                .set_image(url=emblem_bg_url)
             )
-            .add_field(name="Total time played", value=f"{minutes//60}h {minutes%60}m", inline=False)
-            .add_field(name="Time since last played", value=diff, inline=False)
-            .set_thumbnail(url=emblem_url)
-            .set_image(url=emblem_bg_url)
-        )
+    except netreq.DeadlineExceeded:
+        embeds.append(get_timeout_embed())
     return embeds
 
+async def gather_character_data(accounts_data: object, get_data: callable):
+    """
+    Calls get_data(membership type, membership id, character id) for every character of every
+    membership with at most FANOUT_LIMIT requests at once, yielding results as they arrive.
+    Yields TIMED_OUT for requests that ran out of time
+    """
+    limit = asyncio.Semaphore(FANOUT_LIMIT)
+    async def limited(func: callable, *args) -> object:
+        async with limit:
+            try:
+                return await func(*args)
+            except netreq.DeadlineExceeded:
+                return TIMED_OUT
+
+    profile_tasks = {
+        asyncio.create_task(limited(destiny.get_profile_async, account["membershipType"], account["membershipId"]))
+        for account in accounts_data
+    }
+    pending = set(profile_tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                if task not in profile_tasks:
+                    yield result
+                elif result is TIMED_OUT:
+                    yield TIMED_OUT
+                elif result:
+                    #start requests for the characters of a membership as soon as its profile arrives
+                    pending |= {
+                        asyncio.create_task(limited(get_data, result.membership_type, result.membership_id, character_id))
+                        for character_id in result.character_ids
+                    }
+    finally:
+        for task in pending:
+            task.cancel()
+
+def get_timeout_embed() -> Embed:
+    """
+    Gets embed telling that bungie did not answer in time
+    """
+    return Embed(
+        title="Timed out!",
+        description="Bungie.Net took too long to respond, results may be incomplete"
+    )
+
 def get_loading_embed(command: str, name: str, tag: int = None):
     """
     Gets embed for loading for multiple commands
@@ -287,21 +404,21 @@ def get_loading_embed(command: str, name: str, tag: int = None):
         embed.set_author(name="Last activity")
     return embed
 
-def get_search_embed(new_view: OwnedView, name: str, page: int) -> tuple[Embed, OwnedView]:
+async def get_search_embed(new_view: OwnedView, name: str, page: int, page_data: tuple[list[object], bool] = None) -> tuple[Embed, OwnedView]:
     """
-    Gets embed for a page of user search results
+    Gets embed for a page of user search results, given page data is used without any requests
     """
     #get search results
-    payload = {
-        "displayNamePrefix": name
-    }
-    search_data = destiny.post_request_response(f"/User/Search/GlobalName/{page}/", payload)
-    if not search_data:
+    if page_data is None:
+        page_data = await destiny.search_players_async(name, page)
+    if not page_data:
         return None, None
-    has_more = search_data["hasMore"]
-    results = [s for s in search_data["searchResults"] if s["destinyMemberships"]][:25] #avoid overfill
+    results, has_more = page_data
+    results = results[:25] #avoid overfill
     if not results:
         return None, None
+    if has_more: #next page is likely to be opened
+        destiny.prefetch_search_page(name, page + 1)
 
     #for exact lookup
     dropdown = Select(
@@ -366,21 +483,10 @@ def get_eververse_data_embeds(new_view: OwnedView, category: str) -> tuple[list[
     view = new_view
     view.timeout = None
 
-    #all available types of cosmetics
-    available_categories = []
-
-    #look through all items
-    folder = os.listdir(destiny.EVERVERSE_FOLDER)
-    for file in folder:
-        item_data = destiny.read_data_file(os.path.join(destiny.EVERVERSE_FOLDER, file))
-        item_type = item_data["itemTypeDisplayName"]
-
-        if item_type not in available_categories:
-            available_categories.append(item_type)
-
-        if item_type != category:
-            continue
+    snapshot = destiny.get_snapshot()
 
+    #look through items of the category
+    for item_data in snapshot.eververse_items.get(category, ()):
         #item information
         item_name = item_data["displayProperties"]["name"]
         item_text = item_data["flavorText"]
@@ -415,13 +521,11 @@ def get_eververse_data_embeds(new_view: OwnedView, category: str) -> tuple[list[
     else:
         eververse_header = Embed(title=category + "s")
     eververse_header.set_author(name="Daily Eververse Items", icon_url=destiny.EVERVERSE_URL)
-    current_eververse_day = datetime.fromisoformat(read_data_file(destiny.RESETS_FILE)["currentDateDaily"]).date().strftime("%a, %d %b %Y")
-    eververse_header.set_footer(text=current_eververse_day)
+    eververse_header.set_footer(text=snapshot.current_eververse_day)
     embeds.insert(0, eververse_header)
 
     #create buttons to change category
-    available_categories.sort(key=(lambda c : " ".join(c.split(" ")[::-1]) if "Ornament" in c else c)) #group ornaments together
-    for existing in available_categories:
+    for existing in snapshot.eververse_categories:
         if category == existing:
             button_style = ButtonStyle.primary
             disabled = True
@@ -436,13 +540,13 @@ def get_eververse_data_embeds(new_view: OwnedView, category: str) -> tuple[list[
         ))
     return embeds, view
 
-def get_account_data_embeds_weapons(name: str, tag: int) -> tuple[list[Embed], object]:
+async def get_account_data_embeds_weapons(name: str, tag: int) -> tuple[list[Embed], object]:
     """
     Gets formatted embeds with account data from name and tag for top weapons command
     Also returns account object
     """
     #get account data
-    account_data = destiny.get_account_data(name, tag)
+    account_data = await destiny.get_account_data_async(name, tag)
     if not account_data:
         return None, None
 
@@ -467,51 +571,45 @@ def get_account_data_embeds_weapons(name: str, tag: int) -> tuple[list[Embed], o
     )
     return embeds, account_data
 
-def get_top_weapons_embeds(initial: list[Embed], accounts_data: object, amt: int = 3) -> list[Embed]:
+async def get_top_weapons_embeds(initial: list[Embed], accounts_data: object, amt: int = 3) -> list[Embed]:
     """
     Gets embed displaying the top 3 highest kill exotics for an account
     """
     embeds = [initial[0]]
     weapon_counts = {}
 
-    #iterate through each character of each membership
-    for account in accounts_data:
-        membership_type = account["membershipType"]
-        membership_id = account["membershipId"]
-        response = destiny.get_characters_data(membership_type, membership_id)
-        if not response:
+    #add kill counts of each character of each membership to tally as they arrive
+    timed_out = False
+    get_unique_weapons = lambda type, id, character_id: destiny.get_request_response_async(f"/Destiny2/{type}/Account/{id}/Character/{character_id}/Stats/UniqueWeapons/")
+    async for stats in gather_character_data(accounts_data, get_unique_weapons):
+        if stats is TIMED_OUT:
+            timed_out = True
             continue
-        character_ids = list(response)
-        for character_id in character_ids:
-            stats = destiny.get_request_response(f"/Destiny2/{membership_type}/Account/{membership_id}/Character/{character_id}/Stats/UniqueWeapons/")
-            if "weapons" not in stats:
-                continue
-            weapon_data = stats["weapons"]
-            #add kill count to tally
-            for weapon in weapon_data:
-                weapon_id = weapon["referenceId"]
-                weapon_kills = weapon["values"]["uniqueWeaponKills"]["basic"]["value"]
-                if weapon_id in weapon_counts:
-                    weapon_counts[weapon_id] += weapon_kills
-                else:
-                    weapon_counts[weapon_id] = weapon_kills
+        if not stats or "weapons" not in stats:
+            continue
+        for weapon in stats["weapons"]:
+            weapon_id = weapon["referenceId"]
+            weapon_kills = weapon["values"]["uniqueWeaponKills"]["basic"]["value"]
+            weapon_counts[weapon_id] = weapon_counts.get(weapon_id, 0) + weapon_kills
 
     if not weapon_counts:
-        return embeds + [Embed(title="No weapon data found!")]
+        return embeds + [get_timeout_embed() if timed_out else Embed(title="No weapon data found!")]
 
     #sort and get the top
     weapon_counts_list = list(weapon_counts.items())
     weapon_counts_list.sort(key=lambda e: e[1], reverse=True)
     top = weapon_counts_list[:amt]
 
+    #get weapon data
+    weapons_data = await destiny.get_manifest_data_many_async("InventoryItem", [weapon[0] for weapon in top])
+
     #create embeds
     pos = 1
     for weapon in top:
         weapon_hash = weapon[0]
         weapon_kills = int(weapon[1])
 
-        #get weapon data
-        weapon_data = destiny.get_manifest_data("InventoryItem", weapon_hash)
+        weapon_data = weapons_data[weapon_hash]
         weapon_name = weapon_data["displayProperties"]["name"]
         weapon_url = destiny.IMG_ROOT + weapon_data["displayProperties"]["icon"]
         weapon_flavortext = weapon_data["flavorText"]
@@ -531,15 +629,17 @@ def get_top_weapons_embeds(initial: list[Embed], accounts_data: object, amt: int
             .add_field(name="Kills", value=str(weapon_kills))
         )
         pos += 1
+    if timed_out:
+        embeds.append(get_timeout_embed())
     return embeds
 
-def get_account_data_embeds_activity(name: str, tag: int) -> tuple[list[Embed], object]:
+async def get_account_data_embeds_activity(name: str, tag: int) -> tuple[list[Embed], object]:
     """
     Gets formatted embeds with account data from name and tag for last activity command
     Also returns account object
     """
     #get account data
-    account_data = destiny.get_account_data(name, tag)
+    account_data = await destiny.get_account_data_async(name, tag)
     if not account_data:
         return None, None
 
@@ -564,41 +664,42 @@ def get_account_data_embeds_activity(name: str, tag: int) -> tuple[list[Embed],
     )
     return embeds, account_data
 
-def get_last_activity_embeds(initial: list[Embed], accounts_data: object) -> list[Embed]:
+async def get_last_activity_embeds(initial: list[Embed], accounts_data: object) -> list[Embed]:
     """
     Gets embed with stats and information of an accounts most recent activity
     """
     embeds = [initial[0]]
     activities = []
 
-    #get last activity for each character on each account
-    for account in accounts_data:
-        membership_type = account["membershipType"]
-        membership_id = account["membershipId"]
-        response = destiny.get_characters_data(membership_type, membership_id)
-        if not response:
+    #get last activity for each character on each account as histories arrive
+    timed_out = False
+    get_history = lambda type, id, character_id: destiny.get_request_response_async(f"/Destiny2/{type}/Account/{id}/Character/{character_id}/Stats/Activities/" +
+                                                                                     f"?count=11&mode=7&page=0") #for now only pve (mode=7)
+    async for activities_data in gather_character_data(accounts_data, get_history):
+        if activities_data is TIMED_OUT:
+            timed_out = True
             continue
-        character_ids = list(response)
-        for character_id in character_ids:
-            activities_data = destiny.get_request_response(f"/Destiny2/{membership_type}/Account/{membership_id}/Character/{character_id}/Stats/Activities/" +
-                                                           f"?count=11&mode=7&page=0", False) #for now only pve (mode=7)
-            if not activities_data or not activities_data["activities"]:
+        if not activities_data or not activities_data.get("activities"):
+            continue
+
+        activities_list = activities_data["activities"]
+        for idx, activity in enumerate(activities_list):
+            if idx < len(activities_list) - 1 and activity["activityDetails"]["mode"] == 6: #skip patrols (mode=6), until last in list of activities
                 continue
+            activities.append(activity)
+            break
 
-            activities_list = activities_data["activities"]
-            for idx, activity in enumerate(activities_list):
-                if idx < len(activities_list) - 1 and activity["activityDetails"]["mode"] == 6: #skip patrols (mode=6), until last in list of activities
-                    continue
-                reference_id = int(activity["activityDetails"]["instanceId"])
-                activity_report = destiny.get_request_response(f"/Destiny2/Stats/PostGameCarnageReport/{reference_id}/")
-                activities.append(activity_report)
-                break
-
-    #get last activity
-    activities.sort(key=lambda a: datetime.fromisoformat(a["period"].replace("Z", "+00:00")), reverse=True)
+    #get report of only the last activity
     if not activities:
-        return embeds + [Embed(title="No activities found!")]
-    recent_activity = activities[0]
+        return embeds + [get_timeout_embed() if timed_out else Embed(title="No activities found!")]
+    last_activity = max(activities, key=lambda a: datetime.fromisoformat(a["period"].replace("Z", "+00:00")))
+    reference_id = int(last_activity["activityDetails"]["instanceId"])
+    try:
+        recent_activity = await destiny.get_request_response_async(f"/Destiny2/Stats/PostGameCarnageReport/{reference_id}/")
+    except netreq.DeadlineExceeded:
+        return embeds + [get_timeout_embed()]
+    if not recent_activity:
+        return embeds + [Embed(title="Activity report not found!")]
 
     #get activity data
     activity_time = datetime.fromisoformat(recent_activity["period"].replace("Z", "+00:00"))
@@ -606,12 +707,14 @@ def get_last_activity_embeds(initial: list[Embed], accounts_data: object) -> lis
     time_since_played = format_timedelta(now - activity_time)
 
     activity_hash = recent_activity["activityDetails"]["directorActivityHash"]
-    activity_data = destiny.get_manifest_data("Activity", activity_hash)
+    try:
+        activity_data = await destiny.get_manifest_data_async("Activity", activity_hash)
+        destination_data = await destiny.get_manifest_data_async("Destination", activity_data["destinationHash"])
+    except netreq.DeadlineExceeded:
+        return embeds + [get_timeout_embed()]
     activity_name = activity_data["displayProperties"]["name"]
     activity_description = activity_data["displayProperties"]["description"]
     activity_image_url = destiny.IMG_ROOT + activity_data["pgcrImage"]
-
-    destination_data = destiny.get_manifest_data("Destination", activity_data["destinationHash"])
     dest_name = destination_data["displayProperties"]["name"]
 
     #create activity embed
@@ -623,18 +726,22 @@ def get_last_activity_embeds(initial: list[Embed], accounts_data: object) -> lis
                         else "Started from checkpoint ") + time_since_played + " ago",
             value="", inline=False)
         .set_image(url=activity_image_url)
-        .set_footer(text=dest_name)
+        .set_footer(text=dest_name + (" (not all characters could be checked in time)" if timed_out else ""))
     )
 
     #sort list of players by score, or kills if no score
     players = recent_activity["entries"]
     if sum(p["score"]["basic"]["value"] for p in players) == 0:
-        players.sort(key=lambda p: p["values"]["kills"]["basic"]["value"], reverse=True)
+        players = sorted(players, key=lambda p: p["values"]["kills"]["basic"]["value"], reverse=True)
     else:
-        players.sort(key=lambda p: p["score"]["basic"]["value"], reverse=True)
+        players = sorted(players, key=lambda p: p["score"]["basic"]["value"], reverse=True)
     players_hidden = len(players) > 8
     players = players[:8] #max 10 embeds in a message
     activity_completed = 0.0 #see if any player completed activity
+    try:
+        emblems_data = await destiny.get_manifest_data_many_async("InventoryItem", [player["player"]["emblemHash"] for player in players])
+    except netreq.DeadlineExceeded: #keep the activity embed without players
+        return embeds + [get_timeout_embed()]
 
     for idx, player in enumerate(players):
         #player info
@@ -647,8 +754,7 @@ def get_last_activity_embeds(initial: list[Embed], accounts_data: object) -> lis
 
         #emblem
         emblem_url = destiny.IMG_ROOT + player["player"]["destinyUserInfo"]["iconPath"]
-        emblem_hash = player["player"]["emblemHash"]
-        emblem_data = destiny.get_manifest_data("InventoryItem", emblem_hash)
+        emblem_data = emblems_data[player["player"]["emblemHash"]]
         emblem_bg_url = destiny.IMG_ROOT + emblem_data["secondarySpecial"]
 
         #copy emblem color
@@ -700,6 +806,49 @@ def get_last_activity_embeds(initial: list[Embed], accounts_data: object) -> lis
         embeds[1].add_field(name="Did not complete", value="", inline=False)
     return embeds
 
+def get_stats_embed(executor_stats: dict) -> Embed:
+    """
+    Gets embed with runtime statistics of bungie calls, caches and commands
+    """
+    cache = netreq.get_cache_stats()
+    disk = netreq.get_disk_cache_stats()
+    pool = netreq.get_pool_stats()
+    flights = netreq.get_flight_stats()
+    mb = 1024 * 1024
+
+    embed = Embed(title="Runtime Stats")
+    embed.add_field(
+        name="Memory cache",
+        value=f"{cache['entries']} entries, {cache['bytes'] / mb:.1f}/{cache['maxBytes'] / mb:.0f} MB\n" +
+              f"Hit ratio: {cache['hitRatio']:.1%}, evictions: {cache['evictions']}",
+        inline=False
+    )
+    if disk:
+        embed.add_field(name="Disk cache", value=f"{disk['entries']} entries, {disk['bytes'] / mb:.1f} MB", inline=False)
+    embed.add_field(
+        name="Connections",
+        value=f"Sessions: {pool['inUse']} in use, {pool['created']}/{pool['size']} open, waited {pool['waited']} times\n" +
+              f"Coalesced requests: {flights['coalesced']}, in flight: {flights['inFlight']}\n" +
+              f"Worker queue depth: {executor_stats.get('queueDepth', 0)}, running: {executor_stats.get('active', 0)}",
+        inline=False
+    )
+    for api_key, limiter in netreq.get_rate_limit_stats().items():
+        embed.add_field(
+            name=f"Rate limit ({api_key})",
+            value=f"Sent: {limiter['sent']}, waiting: {limiter['waiting']}, throttled: {limiter['throttles']}",
+            inline=False
+        )
+
+    #slowest routes and commands first
+    retries = metrics.get_counter_totals("bungie_retries_total", "route")
+    routes = sorted(metrics.get_latency_summary("bungie_request_seconds", "route").items(), key=lambda r: r[1]["p95"], reverse=True)
+    lines = [f"{route}: {s['count']} calls, p50 {s['p50']}s, p95 {s['p95']}s, {int(retries.get(route, 0))} retries" for route, s in routes[:10]]
+    embed.add_field(name="Bungie routes", value="\n".join(lines) or "No calls yet", inline=False)
+    commands = sorted(metrics.get_latency_summary("command_seconds", "command").items(), key=lambda c: c[1]["p95"], reverse=True)
+    lines = [f"/{command}: {s['count']} uses, avg {s['avg']:.2f}s, p95 {s['p95']}s" for command, s in commands]
+    embed.add_field(name="Commands", value="\n".join(lines) or "No commands yet", inline=False)
+    return embed
+
 def format_timedelta(time: timedelta) -> str:
     """
     Formats a timedelta object for pretty printing
@@ -9,11 +9,14 @@ class Colors:
 
 def write_data_file(data: object, filepath: str) -> None:
     """
-    Write json data to file, path must include folder
+    Write json data to file, path must include folder.
+    The file is replaced atomically so readers never see a partial write
     """
     os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    with open(filepath, "w") as file:
+    temp_path = filepath + ".tmp"
+    with open(temp_path, "w") as file:
         json.dump(data, file, indent=4)
+    os.replace(temp_path, filepath)
 
 def read_data_file(filepath: str) -> object:
     """
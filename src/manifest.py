@@ -0,0 +1,144 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from src.netreq import json_loads
+
+QUERY_CHUNK = 500 #hashes per query, stays under the SQLite parameter limit
+
+class ManifestDatabase:
+    """
+    Local SQLite copy of Destiny manifest definitions, one table per definition type
+    indexed by hash. Each thread gets its own connection.
+    Definition types are rebuilt into a new table and swapped in, so readers are
+    never blocked and always see either the old or the new definitions
+    """
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.local = threading.local()
+        self.tables = None #definition type -> table serving it, loaded on first use
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Gets the connection for the current thread, creating database if needed
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            conn = sqlite3.connect(self.filepath, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            #content path each definition type was last seen with, and the table it is stored in if any
+            conn.execute("CREATE TABLE IF NOT EXISTS definitions (entry TEXT PRIMARY KEY, path TEXT NOT NULL, name TEXT)")
+            conn.commit()
+            self.local.conn = conn
+        return conn
+
+    def get_tables(self) -> dict:
+        """
+        Gets the table serving each stored definition type
+        """
+        if self.tables is None:
+            rows = self.connect().execute("SELECT entry, name FROM definitions WHERE name IS NOT NULL").fetchall()
+            self.tables = dict(rows)
+        return self.tables
+
+    def get_version(self) -> str:
+        """
+        Gets version of the stored manifest, None if nothing is stored
+        """
+        row = self.connect().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else None
+
+    def set_version(self, version: str) -> None:
+        """
+        Sets version of the stored manifest
+        """
+        conn = self.connect()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (version,))
+
+    def get_paths(self) -> dict:
+        """
+        Gets the content path each definition type was last seen with
+        """
+        return dict(self.connect().execute("SELECT entry, path FROM definitions").fetchall())
+
+    def set_path(self, entry: str, path: str) -> None:
+        """
+        Sets the content path a definition type was last seen with, keeping its table
+        """
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "INSERT INTO definitions VALUES (?, ?, NULL) ON CONFLICT (entry) DO UPDATE SET path = excluded.path",
+                (entry, path)
+            )
+
+    def has_table(self, entry: str) -> bool:
+        """
+        Checks if definitions of a type are stored
+        """
+        return entry in self.get_tables()
+
+    def replace_table(self, entry: str, path: str, definitions: dict) -> None:
+        """
+        Builds a new table from definitions keyed by hash and swaps it in for a definition type
+        """
+        name = f"{entry}Definition_{hashlib.sha256(path.encode()).hexdigest()[:12]}"
+        old_name = self.get_tables().get(entry)
+        rows = ((int(hash), json.dumps(data, separators=(",", ":"))) for hash, data in definitions.items())
+        conn = self.connect()
+        with conn:
+            conn.execute(f"DROP TABLE IF EXISTS {name}")
+            conn.execute(f"CREATE TABLE {name} (hash INTEGER PRIMARY KEY, json TEXT NOT NULL)")
+            conn.executemany(f"INSERT INTO {name} VALUES (?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO definitions VALUES (?, ?, ?)", (entry, path, name))
+        #readers switch over on their next lookup
+        self.tables = {**self.get_tables(), entry: name}
+        if old_name and old_name != name:
+            with conn:
+                conn.execute(f"DROP TABLE IF EXISTS {old_name}")
+
+    def get(self, entry: str, hash: int) -> object:
+        """
+        Gets a definition by hash, None if missing
+        """
+        table = self.get_tables().get(entry)
+        if table is None:
+            return None
+        try:
+            row = self.connect().execute(
+                f"SELECT json FROM {table} WHERE hash = ?", (int(hash) & 0xFFFFFFFF,) #hashes are unsigned
+            ).fetchone()
+        except sqlite3.OperationalError: #table was swapped out during lookup
+            return None
+        return json_loads(row[0]) if row else None
+
+    def get_many(self, entry: str, hashes: list) -> dict:
+        """
+        Gets definitions for many hashes with one query per chunk, keyed by the given hashes.
+        Missing hashes are left out
+        """
+        table = self.get_tables().get(entry)
+        if table is None:
+            return {}
+        wanted = {} #unsigned hash -> given hashes
+        for hash in hashes:
+            wanted.setdefault(int(hash) & 0xFFFFFFFF, []).append(hash)
+        keys = list(wanted)
+        conn = self.connect()
+        found = {}
+        try:
+            for idx in range(0, len(keys), QUERY_CHUNK):
+                chunk = keys[idx:idx + QUERY_CHUNK]
+                rows = conn.execute(
+                    f"SELECT hash, json FROM {table} WHERE hash IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                for key, data in rows:
+                    for hash in wanted[key]:
+                        found[hash] = json_loads(data)
+        except sqlite3.OperationalError: #table was swapped out during lookup
+            pass
+        return found
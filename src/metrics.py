@@ -0,0 +1,193 @@
+import os
+import re
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) #in seconds
+
+lock = threading.Lock()
+counters = {} #(name, labels) -> count
+histograms = {} #(name, labels) -> histogram
+gauges = [] #(prefix, label name, callback)
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets
+    """
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1) #last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimates a quantile as the upper bound of the bucket it falls in
+        """
+        target = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if seen >= target and count:
+                return LATENCY_BUCKETS[idx] if idx < len(LATENCY_BUCKETS) else float("inf")
+        return 0.0
+
+def to_labels(labels: dict) -> tuple:
+    """
+    Turns label dict into a hashable sorted tuple
+    """
+    return tuple(sorted(labels.items())) if labels else ()
+
+def inc(name: str, labels: dict = None, amount: float = 1) -> None:
+    """
+    Increases a counter
+    """
+    key = (name, to_labels(labels))
+    with lock:
+        counters[key] = counters.get(key, 0) + amount
+
+def observe(name: str, seconds: float, labels: dict = None) -> None:
+    """
+    Records a latency in a histogram
+    """
+    key = (name, to_labels(labels))
+    with lock:
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = Histogram()
+            histograms[key] = histogram
+        histogram.observe(seconds)
+
+@contextmanager
+def timer(name: str, labels: dict = None):
+    """
+    Records time spent in the with block in a histogram
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, labels)
+
+def register_gauge(prefix: str, callback: callable, label: str = None) -> None:
+    """
+    Registers a callback that returns current values as a dict when metrics are collected.
+    If label is given the callback returns a dict of dicts, the outer keys becoming that label
+    """
+    with lock:
+        gauges.append((prefix, label, callback))
+
+def to_snake_case(name: str) -> str:
+    """
+    Converts camelCase stat names to snake_case metric names
+    """
+    return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+
+def collect_gauges() -> list[tuple[str, tuple, float]]:
+    """
+    Calls all gauge callbacks, returns (name, labels, value) for each numeric value
+    """
+    with lock:
+        registered = list(gauges)
+    collected = []
+    for prefix, label, callback in registered:
+        try:
+            values = callback()
+        except Exception:
+            continue
+        groups = values.items() if label else [(None, values)]
+        for label_value, group in groups:
+            labels = ((label, str(label_value)),) if label else ()
+            if not isinstance(group, dict):
+                group = {"value": group}
+            for stat, value in group.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    collected.append((f"{prefix}_{to_snake_case(stat)}", labels, float(value)))
+    return collected
+
+def format_labels(labels: tuple, extra: tuple = ()) -> str:
+    """
+    Formats labels in Prometheus text format
+    """
+    pairs = labels + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+def render_prometheus() -> str:
+    """
+    Renders all metrics in Prometheus text exposition format
+    """
+    with lock:
+        counter_items = sorted(counters.items())
+        histogram_items = sorted((key, list(h.counts), h.count, h.total) for key, h in histograms.items())
+    lines = []
+    typed = set()
+    for (name, labels), value in counter_items:
+        if name not in typed:
+            lines.append(f"# TYPE {name} counter")
+            typed.add(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    for (name, labels), counts, count, total in histogram_items:
+        if name not in typed:
+            lines.append(f"# TYPE {name} histogram")
+            typed.add(name)
+        cumulative = 0
+        for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{format_labels(labels, (('le', str(bound)),))} {cumulative}")
+        lines.append(f"{name}_sum{format_labels(labels)} {total}")
+        lines.append(f"{name}_count{format_labels(labels)} {count}")
+    for name, labels, value in collect_gauges():
+        if name not in typed:
+            lines.append(f"# TYPE {name} gauge")
+            typed.add(name)
+        lines.append(f"{name}{format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(filepath: str) -> None:
+    """
+    Writes metrics to a file for a Prometheus textfile collector, replacing it atomically
+    """
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    temp_path = filepath + ".tmp"
+    with open(temp_path, "w") as file:
+        file.write(render_prometheus())
+    os.replace(temp_path, filepath)
+
+def get_counter_totals(name: str, label: str) -> dict:
+    """
+    Gets counter values of a metric summed per value of one label
+    """
+    totals = {}
+    with lock:
+        for (counter_name, labels), value in counters.items():
+            if counter_name == name:
+                label_value = dict(labels).get(label, "")
+                totals[label_value] = totals.get(label_value, 0) + value
+    return totals
+
+def get_latency_summary(name: str, label: str) -> dict:
+    """
+    Gets count, average, p50 and p95 latency of a histogram metric per value of one label
+    """
+    summary = {}
+    with lock:
+        for (histogram_name, labels), histogram in histograms.items():
+            if histogram_name != name or not histogram.count:
+                continue
+            summary[dict(labels).get(label, "")] = {
+                "count": histogram.count,
+                "avg": histogram.total / histogram.count,
+                "p50": histogram.quantile(0.5),
+                "p95": histogram.quantile(0.95)
+            }
+    return summary
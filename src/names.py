@@ -0,0 +1,83 @@
+import bisect
+import threading
+from collections import OrderedDict
+from src.io import write_data_file, read_data_file
+
+class NameIndex:
+    """
+    Bounded prefix index of bungie names, kept as a sorted array of case folded names.
+    Least recently seen names are dropped over the limit, saved to a json file between restarts
+    """
+    def __init__(self, filepath: str, max_names: int):
+        self.filepath = filepath
+        self.max_names = max_names
+        self.lock = threading.Lock()
+        self.names = OrderedDict() #case folded name -> name as shown, least recently seen first
+        self.keys = [] #sorted case folded names
+        self.dirty = False
+
+    def insert(self, key: str, name: str) -> None:
+        """
+        Adds or refreshes a name, lock must be held
+        """
+        if key in self.names:
+            self.names.move_to_end(key)
+        else:
+            bisect.insort(self.keys, key)
+        self.names[key] = name
+        while len(self.names) > self.max_names:
+            old_key, _ = self.names.popitem(last=False)
+            del self.keys[bisect.bisect_left(self.keys, old_key)]
+
+    def add(self, name: str, tag: int) -> None:
+        """
+        Adds a bungie name and tag
+        """
+        if not name or tag is None:
+            return
+        name = f"{name}#{str(tag).zfill(4)}"
+        with self.lock:
+            self.insert(name.casefold(), name)
+            self.dirty = True
+
+    def search(self, prefix: str, limit: int = 25) -> list[str]:
+        """
+        Gets up to limit names starting with prefix, not case sensitive
+        """
+        prefix = prefix.casefold()
+        results = []
+        with self.lock:
+            idx = bisect.bisect_left(self.keys, prefix)
+            while idx < len(self.keys) and len(results) < limit and self.keys[idx].startswith(prefix):
+                results.append(self.names[self.keys[idx]])
+                idx += 1
+        return results
+
+    def load(self) -> None:
+        """
+        Loads names saved by a previous run
+        """
+        data = read_data_file(self.filepath) or []
+        with self.lock:
+            for name in data: #least recently seen first
+                self.insert(name.casefold(), name)
+
+    def save(self) -> None:
+        """
+        Saves names if any were added since the last save
+        """
+        with self.lock:
+            if not self.dirty:
+                return
+            data = list(self.names.values())
+            self.dirty = False
+        write_data_file(data, self.filepath)
+
+    def stats(self) -> dict:
+        """
+        Gets amount of indexed names and the limit
+        """
+        return {
+            "names": len(self.names),
+            "maxNames": self.max_names
+        }
@@ -1,16 +1,326 @@
+import os
 import time
-import requests
-from requests import Response
-from datetime import datetime
+import json
+import queue
+import asyncio
+import random
+import hashlib
+import threading
+import aiohttp
+from requests import Session, RequestException
+from requests.adapters import HTTPAdapter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from src.cache import LRUCache, DiskCache, PRIORITY_NORMAL
+from src import metrics
 
-MAX_SIZE = 200
+#use faster json decoding if available
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+CACHE_MAX_BYTES = 64 * 1024 * 1024 #total size budget of cached responses
+CACHE_SHARDS = 16 #each shard gets an equal part of the budget, an entry has to fit in one shard
+DISK_CACHE_MAX_BYTES = 256 * 1024 * 1024 #total size budget of persisted responses
+DISK_CACHE_MAX_AGE = 7 * 24 * 3600 #how long outdated persisted responses are kept for revalidation
 AMT_RETRIES = 10
 RETRY_TIMER_MULT = 1.0 #amount of time increase per retry
-CACHE_TIMEOUT = 240 #in seconds
+RETRY_JITTER = 0.5 #part of each back-off that is randomized
+CONNECT_TIMEOUT = 5.0 #in seconds, lowered to what is left of a deadline
+READ_TIMEOUT = 20.0 #in seconds, lowered to what is left of a deadline
+MIN_TIMEOUT = 0.05 #in seconds, timeouts are never lowered below this
+CACHE_TIMEOUT = 240 #in seconds, default for routes without a policy
+IMMUTABLE = 365 * 24 * 3600 #ttl for responses that never change
+SIZE_CLASSES = { #largest response kept in memory per size class
+    "small": 256 * 1024,
+    "medium": 2 * 1024 * 1024,
+    "large": CACHE_MAX_BYTES // CACHE_SHARDS #largest entry a cache shard can hold
+}
+POOL_SIZE = min(32, (os.cpu_count() or 1) + 4) #same as default asyncio.to_thread worker count
+ASYNC_POOL_SIZE = 100 #max open connections for the asyncio client
+RATE_LIMIT = 20.0 #requests per second per api key
+RATE_BURST = 20 #requests that can be sent at once after being idle
+
+requests_cache = LRUCache(CACHE_MAX_BYTES, CACHE_TIMEOUT, CACHE_SHARDS)
+disk_cache = None #persistent cache, enabled with set_disk_cache
+
+session_pool = queue.LifoQueue() #most recently used session first, keeps warm connections in use
+pool_lock = threading.Lock()
+pool_stats = {
+    "created": 0,
+    "inUse": 0,
+    "acquired": 0,
+    "waited": 0
+}
+async_sessions = {} #one aiohttp session per event loop
+
+rate_limiters = {} #api key -> rate limiter shared by every thread and event loop
+rate_limiters_lock = threading.Lock()
+
+in_flight = {} #cache key -> future of the identical request currently being made
+in_flight_lock = threading.Lock()
+flight_stats = {
+    "leaders": 0,
+    "coalesced": 0
+}
+
+current_deadline = ContextVar("current_deadline", default=None) #monotonic time the calling command must be done by
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when the time budget of the calling command has run out
+    """
+
+class HttpResult:
+    """
+    Status code, headers and body decoded once of a finished request,
+    shared by the blocking and asyncio clients and their cache.
+    The decoded payload is shared between callers and must not be modified,
+    the raw body is only kept until the result has been persisted
+    """
+    __slots__ = ("status_code", "headers", "payload", "size", "content")
+
+    def __init__(self, status_code: int, headers: object, payload: object, size: int, content: bytes = None):
+        self.status_code = status_code
+        self.headers = headers
+        self.payload = payload
+        self.size = size
+        self.content = content
+
+    def __bool__(self) -> bool:
+        return self.status_code < 400
+
+    def json(self) -> object:
+        return self.payload
+
+class CachePolicy:
+    """
+    How long responses of a route are cached (ttl of None means never),
+    how important they are to keep when evicting, how large they may be
+    and whether they are persisted to disk
+    """
+    __slots__ = ("name", "ttl", "priority", "max_size", "persist")
+
+    def __init__(self, name: str, ttl: float, priority: int = PRIORITY_NORMAL, size_class: str = "medium", persist: bool = False):
+        self.name = name
+        self.ttl = ttl
+        self.priority = priority
+        self.max_size = SIZE_CLASSES[size_class]
+        self.persist = persist
+
+class RateLimiter:
+    """
+    Token bucket (as generic cell rate algorithm) shared by all callers using the same api key.
+    Callers reserve send slots in order of arrival so waiting callers are served fairly,
+    and a server throttle moves every reserved and future slot back
+    """
+    def __init__(self, rate: float, burst: int):
+        self.lock = threading.Lock()
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self.next_time = 0.0 #theoretical send time of next request
+        self.blocked_until = 0.0
+        self.shift = 0.0 #total time slots have been moved back by throttles
+        self.waiting = 0
+        self.sent = 0
+        self.throttles = 0
+
+    def reserve(self) -> tuple[float, float]:
+        """
+        Reserves the next send slot, returns slot time and the current throttle shift
+        """
+        with self.lock:
+            now = time.monotonic()
+            next_time = max(self.next_time, now)
+            slot = max(now, next_time - self.tolerance, self.blocked_until)
+            self.next_time = max(next_time, slot) + self.interval
+            self.waiting += 1
+            return slot, self.shift
+
+    def get_delay(self, slot: float, shift: float) -> tuple[float, float, float]:
+        """
+        Gets time left until a reserved slot, including throttles made after reserving it.
+        Also returns the updated slot and shift, marks slot as used if no time is left
+        """
+        with self.lock:
+            slot += self.shift - shift
+            delay = slot - time.monotonic()
+            if delay <= 0:
+                self.waiting -= 1
+                self.sent += 1
+            return delay, slot, self.shift
+
+    def wait(self) -> None:
+        """
+        Blocks until caller is allowed to send a request,
+        raises DeadlineExceeded if that is after the current deadline
+        """
+        slot, shift = self.reserve()
+        try:
+            delay, slot, shift = self.get_delay(slot, shift)
+            while delay > 0:
+                check_deadline(delay)
+                time.sleep(delay)
+                delay, slot, shift = self.get_delay(slot, shift)
+        except BaseException:
+            self.cancel()
+            raise
+
+    async def wait_async(self) -> None:
+        """
+        Waits without blocking the event loop until caller is allowed to send a request,
+        raises DeadlineExceeded if that is after the current deadline
+        """
+        slot, shift = self.reserve()
+        try:
+            delay, slot, shift = self.get_delay(slot, shift)
+            while delay > 0:
+                check_deadline(delay)
+                await asyncio.sleep(delay)
+                delay, slot, shift = self.get_delay(slot, shift)
+        except BaseException:
+            self.cancel()
+            raise
+
+    def cancel(self) -> None:
+        """
+        Gives up a reserved slot that was not used
+        """
+        with self.lock:
+            self.waiting -= 1
 
-key_order = []
-key_times = {}
-requests_cache = {}
+    def throttle(self, seconds: float) -> None:
+        """
+        Stops all callers from sending for some seconds, as requested by the server
+        """
+        with self.lock:
+            now = time.monotonic()
+            until = now + seconds
+            self.throttles += 1
+            if until <= self.blocked_until:
+                return
+            added = until - max(now, self.blocked_until)
+            self.blocked_until = until
+            self.shift += added
+            #no burst after being throttled
+            self.next_time = max(self.next_time + added, until + self.tolerance)
+
+    def stats(self) -> dict:
+        """
+        Gets amount of requests sent, waiting and throttled
+        """
+        with self.lock:
+            return {
+                "rate": 1 / self.interval,
+                "sent": self.sent,
+                "waiting": self.waiting,
+                "throttles": self.throttles,
+                "blockedFor": max(0.0, self.blocked_until - time.monotonic())
+            }
+
+def create_result(status_code: int, headers: object, content: bytes) -> HttpResult:
+    """
+    Creates result from a raw response, decoding the json body,
+    payload is None if body is not json
+    """
+    try:
+        payload = json_loads(content)
+    except ValueError:
+        payload = None
+    return HttpResult(status_code, headers, payload, len(content), content)
+
+def create_session() -> Session:
+    """
+    Creates a keep-alive session, each session is only used by one thread at a time
+    """
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=1)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@contextmanager
+def pooled_session():
+    """
+    Borrows a session from the pool, creates a new one if the pool is not full
+    and waits for one to be returned otherwise, for at most the time left of the current deadline
+    """
+    try:
+        session = session_pool.get_nowait()
+    except queue.Empty:
+        with pool_lock:
+            create = pool_stats["created"] < POOL_SIZE
+            if create:
+                pool_stats["created"] += 1
+            else:
+                pool_stats["waited"] += 1
+        session = create_session() if create else get_idle_session()
+    with pool_lock:
+        pool_stats["inUse"] += 1
+        pool_stats["acquired"] += 1
+    try:
+        yield session
+    finally:
+        with pool_lock:
+            pool_stats["inUse"] -= 1
+        session_pool.put(session)
+
+def get_idle_session() -> Session:
+    """
+    Waits for a session to be returned to the pool,
+    raises DeadlineExceeded if none is returned before the current deadline
+    """
+    remaining = get_remaining_time()
+    try:
+        return session_pool.get(timeout=None if remaining is None else max(remaining, 0.0))
+    except queue.Empty:
+        metrics.inc("bungie_deadline_exceeded_total")
+        raise DeadlineExceeded("Deadline exceeded while waiting for a pooled session") from None
+
+def get_pool_stats() -> dict:
+    """
+    Gets a copy of the session pool statistics
+    """
+    with pool_lock:
+        stats = dict(pool_stats)
+    stats["idle"] = session_pool.qsize()
+    stats["size"] = POOL_SIZE
+    return stats
+
+def close_sessions() -> None:
+    """
+    Closes all idle sessions and their connections
+    """
+    while True:
+        try:
+            session = session_pool.get_nowait()
+        except queue.Empty:
+            break
+        session.close()
+        with pool_lock:
+            pool_stats["created"] -= 1
+
+async def get_async_session() -> aiohttp.ClientSession:
+    """
+    Gets the keep-alive aiohttp session for the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    session = async_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE)
+        session = aiohttp.ClientSession(connector=connector)
+        async_sessions[loop] = session
+    return session
+
+async def close_async_session() -> None:
+    """
+    Closes the aiohttp session of the running event loop
+    """
+    session = async_sessions.pop(asyncio.get_running_loop(), None)
+    if session:
+        await session.close()
 
 def create_key(url: str, header: object, json: object, data_http: object) -> str:
     """
@@ -18,72 +328,469 @@ def create_key(url: str, header: object, json: object, data_http: object) -> str
     """
     return f"{url};{str(header)};{str(json)};{str(data_http)}"
 
-def do_retry_request(use_cache: bool, is_get: bool, url: str, header: object, json: object = None, data_http: object = None) -> Response:
+@contextmanager
+def deadline(seconds: float, detached: bool = False):
+    """
+    Gives every request made in the with block, including in asyncio.to_thread workers,
+    a shared time budget. A nested deadline can only shorten the budget unless detached,
+    for background work that should outlive the caller's budget
+    """
+    end = time.monotonic() + seconds
+    outer = None if detached else current_deadline.get()
+    token = current_deadline.set(end if outer is None else min(end, outer))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+def get_remaining_time() -> float:
+    """
+    Gets seconds left of the current deadline, None if there is no deadline
+    """
+    end = current_deadline.get()
+    if end is None:
+        return None
+    return end - time.monotonic()
+
+def check_deadline(needed: float = 0.0) -> None:
+    """
+    Raises DeadlineExceeded if less than the needed time is left of the current deadline
+    """
+    remaining = get_remaining_time()
+    if remaining is not None and remaining <= needed:
+        metrics.inc("bungie_deadline_exceeded_total")
+        raise DeadlineExceeded(f"Deadline exceeded, {max(remaining, 0.0):.2f}s left but {needed:.2f}s needed")
+
+def get_timeouts() -> tuple[float, float, float]:
+    """
+    Gets connect, read and total timeouts right before sending, capped by what is left
+    of the current deadline (total is None without a deadline).
+    Raises DeadlineExceeded if no time is left
+    """
+    check_deadline()
+    remaining = get_remaining_time()
+    if remaining is None:
+        return CONNECT_TIMEOUT, READ_TIMEOUT, None
+    remaining = max(remaining, MIN_TIMEOUT)
+    return min(CONNECT_TIMEOUT, remaining), min(READ_TIMEOUT, remaining), remaining
+
+def join_flight(key: str) -> tuple[Future, bool]:
+    """
+    Gets the future for an in-flight request with the same key,
+    also returns whether caller is the first and has to make the request
+    """
+    with in_flight_lock:
+        future = in_flight.get(key)
+        if future is not None:
+            flight_stats["coalesced"] += 1
+            return future, False
+        future = Future()
+        in_flight[key] = future
+        flight_stats["leaders"] += 1
+        return future, True
+
+def land_flight(key: str, future: Future, data: "HttpResult" = None, error: BaseException = None) -> None:
+    """
+    Hands the result (or error) of an in-flight request to every waiting caller.
+    Errors of the first caller itself, such as its deadline running out or it being cancelled,
+    are not handed on. Waiting callers get None instead and one of them makes the request
+    """
+    with in_flight_lock:
+        in_flight.pop(key, None)
+    if error is None or is_caller_error(error):
+        future.set_result(data)
+    else:
+        future.set_exception(error)
+
+def is_caller_error(error: BaseException) -> bool:
+    """
+    Checks if an error came from the caller giving up rather than from the request
+    """
+    return isinstance(error, DeadlineExceeded) or not isinstance(error, Exception)
+
+def wait_flight(future: Future) -> HttpResult:
+    """
+    Waits for an in-flight request for at most the time left of the current deadline,
+    returns None if the first caller gave up without a result
+    """
+    try:
+        return future.result(timeout=get_remaining_time())
+    except FutureTimeoutError:
+        raise DeadlineExceeded("Deadline exceeded while waiting for identical request") from None
+
+async def wait_flight_async(future: Future) -> HttpResult:
+    """
+    Waits for an in-flight request for at most the time left of the current deadline,
+    shielded so that giving up never cancels the request for other callers.
+    Returns None if the first caller gave up without a result
+    """
+    try:
+        return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), get_remaining_time())
+    except asyncio.TimeoutError:
+        raise DeadlineExceeded("Deadline exceeded while waiting for identical request") from None
+
+def set_disk_cache(filepath: str) -> None:
+    """
+    Enables persistent response cache stored in given file
+    """
+    global disk_cache
+    disk_cache = DiskCache(filepath, DISK_CACHE_MAX_BYTES, DISK_CACHE_MAX_AGE)
+
+def is_cached(policy: CachePolicy) -> bool:
     """
-    Performs a HTTP request and retries some times if server error
+    Checks if responses under a policy are cached
     """
+    return policy is not None and bool(policy.ttl)
+
+def can_persist(policy: CachePolicy, header: object) -> bool:
+    """
+    Checks if response of a request may be persisted,
+    OAuth responses hold private account data and are never written to disk
+    """
+    return is_cached(policy) and policy.persist and disk_cache is not None and not (header and "Authorization" in header)
+
+def hash_key(key: str) -> str:
+    """
+    Hashes cache key for the persistent cache, so api keys are not written to disk
+    """
+    return hashlib.sha256(key.encode()).hexdigest()
+
+def get_freshness(headers: object, ttl: float) -> float:
+    """
+    Gets amount of seconds a response can be reused from its Cache-Control header,
+    never less than the route's ttl. Returns None if response must not be stored
+    """
+    cache_control = headers.get("Cache-Control", "") if headers else ""
+    directives = [d.strip().lower() for d in cache_control.split(",")]
+    if "no-store" in directives:
+        return None
+    for directive in directives:
+        if directive.startswith("max-age="):
+            try:
+                return max(float(directive[8:]), ttl)
+            except ValueError:
+                break
+    return ttl
+
+def lookup_disk_cache(key: str, policy: CachePolicy) -> tuple[HttpResult, tuple]:
+    """
+    Looks for a persisted response, returns it if still fresh.
+    Otherwise returns the stored row if it has validators so it can be revalidated
+    """
+    row = disk_cache.get(hash_key(key))
+    if row is None:
+        return None, None
+    body, etag, last_modified, expires = row
+    remaining = expires - time.time()
+    if remaining > 0:
+        data = create_result(200, {}, body)
+        data.content = None
+        insert_cache(key, data, policy, min(remaining, policy.ttl))
+        return data, None
+    if etag or last_modified:
+        return None, row
+    return None, None
+
+def get_conditional_header(header: object, stored: tuple) -> object:
+    """
+    Adds validators of a stored response to request headers
+    """
+    if not stored:
+        return header
+    _, etag, last_modified, _ = stored
+    conditional = dict(header or {})
+    if etag:
+        conditional["If-None-Match"] = etag
+    if last_modified:
+        conditional["If-Modified-Since"] = last_modified
+    return conditional
+
+def store_result(data: HttpResult, stored: tuple, policy: CachePolicy, key: str, url: str, header: object) -> HttpResult:
+    """
+    Adds a finished request to the caches, a not modified answer reuses the stored response.
+    Returns the result to hand to callers
+    """
+    if not is_cached(policy):
+        data.content = None
+        return data
+    persist = can_persist(policy, header)
+    freshness = get_freshness(data.headers, policy.ttl)
+    if data.status_code == 304 and stored:
+        data = create_result(200, data.headers, stored[0])
+        if persist and freshness is not None:
+            disk_cache.refresh(hash_key(key), time.time() + freshness)
+    elif persist and data and freshness is not None and data.size <= policy.max_size:
+        etag = data.headers.get("ETag")
+        last_modified = data.headers.get("Last-Modified")
+        disk_cache.put(hash_key(key), url, data.content, etag, last_modified, time.time() + freshness)
+    data.content = None
+    if data:
+        insert_cache(key, data, policy, policy.ttl)
+    return data
+
+def insert_cache(key: str, data: HttpResult, policy: CachePolicy, ttl: float) -> None:
+    """
+    Inserts result into memory cache if its size fits the policy's size class,
+    responses too large are counted per route
+    """
+    if data.size > policy.max_size or not requests_cache.put(key, data, len(key) + data.size, ttl, policy.priority):
+        metrics.inc("bungie_cache_too_large_total", {"route": policy.name})
+
+def get_rate_limiter(header: object) -> RateLimiter:
+    """
+    Gets the rate limiter for the api key used in the request headers
+    """
+    api_key = header.get("X-API-KEY") if header else None
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(api_key)
+        if limiter is None:
+            limiter = RateLimiter(RATE_LIMIT, RATE_BURST)
+            rate_limiters[api_key] = limiter
+        return limiter
+
+def get_route(policy: CachePolicy) -> str:
+    """
+    Gets route name used for metrics
+    """
+    return policy.name if policy else "uncached"
+
+def record_response(route: str, data: HttpResult, start: float, sent: float) -> None:
+    """
+    Records rate limit wait, latency and status of one request attempt
+    """
+    now = time.perf_counter()
+    metrics.observe("bungie_rate_limit_wait_seconds", sent - start, {"route": route})
+    metrics.observe("bungie_request_seconds", now - sent, {"route": route})
+    metrics.inc("bungie_responses_total", {"route": route, "status": str(data.status_code)})
+
+def get_backoff(atts: int) -> float:
+    """
+    Gets jittered back-off time before retry number atts + 1
+    """
+    return (1 + atts * RETRY_TIMER_MULT) * random.uniform(1 - RETRY_JITTER, 1)
+
+def get_retry_delay(data: HttpResult, atts: int, limiter: RateLimiter, route: str) -> float:
+    """
+    Gets time to wait before retrying a server error,
+    returns None if request should not be retried.
+    Server throttles are applied to the rate limiter so every caller waits
+    """
+    if (data.status_code - 1) // 100 != 5 or atts >= AMT_RETRIES: #the -1 is to ignore code 500 (genious)
+        return None
+    payload = data.json()
+    throttle_time = payload.get("ThrottleSeconds", 0) if isinstance(payload, dict) else 0
+    metrics.inc("bungie_retries_total", {"route": route})
+    if throttle_time:
+        metrics.inc("bungie_throttles_total", {"route": route})
+        limiter.throttle(throttle_time)
+        return 0
+    return get_backoff(atts)
+
+def get_error_delay(error: Exception, atts: int, route: str) -> float:
+    """
+    Gets time to wait before retrying after a connection error or timeout,
+    raises DeadlineExceeded if the deadline caused it and the error itself if out of retries
+    """
+    check_deadline()
+    metrics.inc("bungie_errors_total", {"route": route, "error": type(error).__name__})
+    if atts >= AMT_RETRIES:
+        raise error
+    metrics.inc("bungie_retries_total", {"route": route})
+    return get_backoff(atts)
+
+def do_retry_request(policy: CachePolicy, is_get: bool, url: str, header: object, json: object = None, data_http: object = None) -> HttpResult:
+    """
+    Performs a HTTP request and retries some times if server error, cached according to policy
+    (None to never cache). Identical requests made at the same time wait for the first one's result.
+    Raises DeadlineExceeded if the current deadline runs out
+    """
+    key = create_key(url, header, json, data_http)
     #check in cache
-    if use_cache:
-        data = cache_lookup(url, header, json, data_http)
+    if is_cached(policy):
+        data = requests_cache.get(key)
+        metrics.inc("bungie_cache_lookups_total", {"route": policy.name, "result": "hit" if data else "miss"})
         if data:
-            # print("cache " + create_key(url, header, json, data_http))
             return data
-    # print("not cache " + create_key(url, header, json, data_http))
-    #create request function
-    if is_get:
-        request_func = lambda: requests.get(url, headers=header)
-    else:
-        request_func = lambda: requests.post(url, data=data_http, json=json, headers=header)
+    #wait for identical request if one is already being made
+    future, leader = join_flight(key)
+    while not leader:
+        data = wait_flight(future)
+        if data is not None:
+            return data
+        #first caller gave up, try again and make the request if no one else has started it
+        future, leader = join_flight(key)
+    try:
+        #check persisted responses
+        data, stored = lookup_disk_cache(key, policy) if can_persist(policy, header) else (None, None)
+        if data is None:
+            data = send_request(get_route(policy), is_get, url, get_conditional_header(header, stored), header, json, data_http)
+            data = store_result(data, stored, policy, key, url, header)
+    except BaseException as e:
+        land_flight(key, future, error=e)
+        raise
+    land_flight(key, future, data)
+    return data
+
+def send_request(route: str, is_get: bool, url: str, request_header: object, header: object, json: object, data_http: object) -> HttpResult:
+    """
+    Sends request through the rate limiter on a pooled keep-alive session, retrying server errors
+    and connection errors while the current deadline allows it
+    """
+    limiter = get_rate_limiter(header)
+    def request_func() -> HttpResult:
+        start = time.perf_counter()
+        limiter.wait()
+        sent = time.perf_counter()
+        with pooled_session() as session:
+            timeouts = get_timeouts()[:2]
+            if is_get:
+                response = session.get(url, headers=request_header, timeout=timeouts)
+            else:
+                response = session.post(url, data=data_http, json=json, headers=request_header, timeout=timeouts)
+        data = create_result(response.status_code, response.headers, response.content)
+        record_response(route, data, start, sent)
+        return data
     #do request
-    data = request_func()
     atts = 0
-    while (data.status_code - 1) // 100 == 5 and atts < AMT_RETRIES: #the -1 is to ignore code 500 (genious)
-        throttle_time = data.json()["ThrottleSeconds"]
-        if throttle_time != 0:
-            time.sleep(throttle_time)
+    while True:
+        check_deadline()
+        try:
+            data = request_func()
+        except RequestException as e:
+            delay = get_error_delay(e, atts, route)
         else:
-            time.sleep(1 + atts * RETRY_TIMER_MULT)
-        data = request_func()
+            delay = get_retry_delay(data, atts, limiter, route)
+            if delay is None:
+                return data
+        check_deadline(delay) #no time left for back-off and another attempt
+        time.sleep(delay)
         atts += 1
-        #print(f"Attempt {atts} Code {data.status_code}")
-    #add to cache
-    if use_cache and data:
-        insert_cache(data, url, header, json, data_http)
-    return data
 
-def insert_cache(data: object, url: str, header: object, json: object, data_http: object) -> None:
+async def do_retry_request_async(policy: CachePolicy, is_get: bool, url: str, header: object, json: object = None, data_http: object = None) -> HttpResult:
     """
-    Inserts into cache
+    Performs a HTTP request without blocking the event loop and retries some times if server error,
+    shares cache policies, retry behaviour, deadlines and in-flight requests with do_retry_request
     """
     key = create_key(url, header, json, data_http)
-    #add data to cache and refresh timer
-    requests_cache[key] = data
-    key_times[key] = datetime.now()
-    #refresh LRU order and maintain cache size
-    if key not in key_order:
-        key_order.insert(0, key)
-        while len(key_order) > MAX_SIZE:
-            last_key = key_order.pop()
-            key_times.pop(last_key)
-            requests_cache.pop(last_key)
-    else:
-        key_order.remove(key)
-        key_order.insert(0, key)
+    #check in cache
+    if is_cached(policy):
+        data = requests_cache.get(key)
+        metrics.inc("bungie_cache_lookups_total", {"route": policy.name, "result": "hit" if data else "miss"})
+        if data:
+            return data
+    #wait for identical request if one is already being made
+    future, leader = join_flight(key)
+    while not leader:
+        data = await wait_flight_async(future)
+        if data is not None:
+            return data
+        #first caller gave up, try again and make the request if no one else has started it
+        future, leader = join_flight(key)
+    try:
+        #check persisted responses, disk access runs in a worker thread to not block the event loop
+        persist = can_persist(policy, header)
+        data, stored = await asyncio.to_thread(lookup_disk_cache, key, policy) if persist else (None, None)
+        if data is None:
+            data = await send_request_async(get_route(policy), is_get, url, get_conditional_header(header, stored), header, json, data_http)
+            if persist:
+                data = await asyncio.to_thread(store_result, data, stored, policy, key, url, header)
+            else:
+                data = store_result(data, stored, policy, key, url, header)
+    except BaseException as e:
+        land_flight(key, future, error=e)
+        raise
+    land_flight(key, future, data)
+    return data
 
-def cache_lookup(url: str, header: object, json: object, data_http: object) -> object:
+async def send_request_async(route: str, is_get: bool, url: str, request_header: object, header: object, json: object, data_http: object) -> HttpResult:
     """
-    Looks if request is in cache, returns data if it is
+    Sends request through the rate limiter on the aiohttp session, retrying server errors
+    and connection errors while the current deadline allows it
     """
-    key = create_key(url, header, json, data_http)
-    if key in requests_cache:
-        #check if cache is outdated
-        if (datetime.now() - key_times[key]).total_seconds() > CACHE_TIMEOUT:
-            key_order.remove(key)
-            key_times.pop(key)
-            requests_cache.pop(key)
-            return None
-        #refresh LRU
-        key_order.remove(key)
-        key_order.insert(0, key)
-        return requests_cache[key]
-    return None
+    limiter = get_rate_limiter(header)
+    async def request_func() -> HttpResult:
+        start = time.perf_counter()
+        await limiter.wait_async()
+        sent = time.perf_counter()
+        session = await get_async_session()
+        connect_timeout, read_timeout, total_timeout = get_timeouts()
+        timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        if is_get:
+            context = session.get(url, headers=request_header, timeout=timeout)
+        else:
+            context = session.post(url, data=data_http, json=json, headers=request_header, timeout=timeout)
+        async with context as response:
+            data = create_result(response.status, response.headers, await response.read())
+        record_response(route, data, start, sent)
+        return data
+    #do request
+    atts = 0
+    while True:
+        check_deadline()
+        try:
+            data = await request_func()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            delay = get_error_delay(e, atts, route)
+        else:
+            delay = get_retry_delay(data, atts, limiter, route)
+            if delay is None:
+                return data
+        check_deadline(delay) #no time left for back-off and another attempt
+        await asyncio.sleep(delay)
+        atts += 1
+
+def expire_cache() -> int:
+    """
+    Removes all outdated responses from memory and prunes the persistent cache,
+    returns amount removed
+    """
+    removed = requests_cache.expire()
+    if disk_cache:
+        removed += disk_cache.prune()
+    return removed
+
+def invalidate_url_prefix(prefix: str) -> int:
+    """
+    Removes cached and persisted responses for urls starting with prefix,
+    returns amount removed
+    """
+    removed = requests_cache.invalidate(lambda key: key.startswith(prefix)) #keys start with the url
+    if disk_cache:
+        removed += disk_cache.delete_url_prefix(prefix)
+    return removed
+
+def get_flight_stats() -> dict:
+    """
+    Gets amount of requests made and amount that waited on an identical in-flight request
+    """
+    with in_flight_lock:
+        stats = dict(flight_stats)
+    stats["inFlight"] = len(in_flight)
+    return stats
+
+def get_rate_limit_stats() -> dict:
+    """
+    Gets rate limiter statistics for each api key, keys are masked
+    """
+    with rate_limiters_lock:
+        limiters = list(rate_limiters.items())
+    return {(api_key or "none")[:4] + "...": limiter.stats() for api_key, limiter in limiters}
+
+def get_cache_stats() -> dict:
+    """
+    Gets cache size and hit/miss/eviction counts
+    """
+    return requests_cache.stats()
+
+def get_disk_cache_stats() -> dict:
+    """
+    Gets amount and size of persisted responses
+    """
+    return disk_cache.stats() if disk_cache else {}
+
+#expose runtime statistics as metrics
+metrics.register_gauge("bungie_cache", get_cache_stats)
+metrics.register_gauge("bungie_disk_cache", get_disk_cache_stats)
+metrics.register_gauge("bungie_session_pool", get_pool_stats)
+metrics.register_gauge("bungie_in_flight", get_flight_stats)
+metrics.register_gauge("bungie_rate_limit", get_rate_limit_stats, "api_key")
@@ -100,10 +100,9 @@ def get_set_oauth(code: bool = None) -> str:
             "grant_type": "authorization_code",
             "code": code
         }
-    data_raw = do_retry_request(False, False, url, header, data_http=info)
-    if "error" in data_raw.json():
+    data = do_retry_request(None, False, url, header, data_http=info).json()
+    if not data or "error" in data:
         return None
-    data = data_raw.json()
 
     refresh_data = {
         "token": data["refresh_token"],